@@ -1,55 +1,219 @@
+import functools
 import io
+import posixpath
+import re
 import stat
+import tarfile
 
 from fwtool import mbr
-from fwtool.archive import cramfs, fat, tar, UnixFile
+from fwtool.archive import fat, UnixFile
 from fwtool.sony import flash
 
+from . import cache, cramfs, image, patch
+from .util import *
+
+def _readContents(contents):
+ if contents is None:
+  return None
+ contents.seek(0)
+ return contents.read()
+
+def _freezeContents(contents):
+ # Lazy contents backed by an image are kept as is
+ return contents.image if isinstance(contents, image.ImageReader) else _readContents(contents)
+
+def _thawContents(data):
+ if data is None:
+  return None
+ return data.open() if isinstance(data, image.Image) else io.BytesIO(data)
+
+def _key(data):
+ # Read-only views (e.g. from the firmware store) are hashable without copying
+ return data if isinstance(data, memoryview) and data.readonly else bytes(image.getvalue(data))
+
 class Archive:
- def __init__(self, files=[]):
+ def __init__(self, files=[], runs={}):
   self.files = {f.path: f for f in files}
+  # Compressed data of the source image, by path
+  self.runs = runs
+
+ def freeze(self):
+  return tuple((f._replace(contents=None), _freezeContents(f.contents)) for f in self.files.values())
+
+ @classmethod
+ def thaw(cls, snapshot):
+  return cls(f._replace(contents=_thawContents(data)) for f, data in snapshot)
+
+ def copy(self):
+  a = self.thaw(self.freeze())
+  a.runs = self.runs
+  return a
 
  def read(self, path):
-  c = self.files[path].contents
-  c.seek(0)
-  return c.read()
+  return _readContents(self.files[path].contents)
 
  def write(self, path, data):
   f = self.files.get(path, UnixFile(path=path, size=-1, mtime=0, mode=stat.S_IFREG | 0o775, uid=0, gid=0, contents=None))
   self.files[path] = f._replace(contents=io.BytesIO(data))
 
- def patch(self, path, func):
-  self.write(path, func(self.read(path)))
+ def patch(self, path, patches):
+  data = self.read(path)
+  self.write(path, patches(data) if callable(patches) else patch.apply(data, patches))
 
  def writeAll(self, archive, path=''):
   for f in archive.files.values():
    self.files[path+f.path] = f._replace(path=path+f.path)
 
+@functools.lru_cache(16)
+def _readFat(data):
+ return Archive(fat.readFat(io.BytesIO(data))).freeze()
+
 def readFat(data):
- return Archive(fat.readFat(io.BytesIO(data)))
+ return Archive.thaw(_readFat(_key(data)))
 
-def writeFat(archive, size):
+def _writeFat(files, size):
  f = io.BytesIO()
- fat.writeFat(archive.files.values(), size, f)
+ fat.writeFat([file._replace(contents=_thawContents(data)) for file, data in files], size, f)
  return f.getvalue()
 
+def writeFat(archive, size, parallel=True):
+ # Each partition is written in a worker process, so independent partitions are built in parallel
+ executor = getProcessExecutor() if parallel else None
+ if not executor:
+  f = io.BytesIO()
+  fat.writeFat(archive.files.values(), size, f)
+  return image.fromBytes(f.getbuffer())
+ files = [(file._replace(contents=None), _readContents(file.contents)) for file in archive.files.values()]
+ return image.fromBytes(executor.submit(_writeFat, files, size).result())
+
+@functools.lru_cache(16)
+def _readCramfs(data):
+ runs = {}
+ snapshot = Archive(cramfs.readCramfs(data, runs)).freeze()
+ return snapshot, {f.path: (contents, runs[f.path]) for f, contents in snapshot if f.path in runs}
+
 def readCramfs(data):
- return Archive(cramfs.readCramfs(io.BytesIO(data)))
+ snapshot, runs = _readCramfs(_key(data))
+ archive = Archive.thaw(snapshot)
+ archive.runs = runs
+ return archive
 
-def writeCramfs(archive):
+def writeCramfs(archive, parallel=True):
  f = io.BytesIO()
- cramfs.writeCramfs(archive.files.values(), f)
+ cramfs.writeCramfs(archive.files.values(), f, getExecutor() if parallel else None, archive.runs)
  return f.getvalue()
 
+TAR_TYPES = [
+ (tarfile.TarInfo.isreg, stat.S_IFREG),
+ (tarfile.TarInfo.isdir, stat.S_IFDIR),
+ (tarfile.TarInfo.issym, stat.S_IFLNK),
+ (tarfile.TarInfo.ischr, stat.S_IFCHR),
+ (tarfile.TarInfo.isblk, stat.S_IFBLK),
+ (tarfile.TarInfo.isfifo, stat.S_IFIFO),
+]
+
+@functools.lru_cache(16)
+def _readTar(data):
+ # Members point into the tar data and are only read when their contents are used
+ view = memoryview(data).cast('B')
+ f = image.Image([view]).open()
+ files = []
+ with tarfile.open(fileobj=f) as t:
+  for m in t:
+   path = posixpath.normpath('/' + m.name)
+   if path == '/':
+    continue
+   if m.islnk():
+    m = t.getmember(m.linkname)
+   contents = None
+   size = m.size
+   if m.issym():
+    contents = m.linkname.encode('latin1')
+    size = len(contents)
+   elif m.isreg() and t.fileobj is f and not m.issparse():
+    contents = image.Image([view[m.offset_data:m.offset_data+m.size]])
+   elif m.isreg():
+    contents = t.extractfile(m).read()
+   mode = next((type for test, type in TAR_TYPES if test(m)), 0) | m.mode
+   files.append((UnixFile(path=path, size=size, mtime=m.mtime, mode=mode, uid=m.uid, gid=m.gid, contents=None), contents))
+ return tuple(files)
+
 def readTar(data):
- return Archive(tar.readTar(io.BytesIO(data)))
+ return Archive.thaw(_readTar(_key(data)))
+
+class _PartitionReader(image.ImageReader):
+ # Records where in the output the partition is copied to
+ def __init__(self, data, out):
+  super().__init__(data if isinstance(data, image.Image) else image.Image([data]))
+  self.out = out
+  self.offset = None
+
+ def readinto(self, b):
+  if self.offset is None and self.pos == 0:
+   self.offset = self.out.tell()
+  return super().readinto(b)
 
 def writeFlash(partitions):
  f = io.BytesIO()
- flash.writePartitions([io.BytesIO(p) for p in partitions], f)
- return f.getvalue()
+ readers = [_PartitionReader(p, f) for p in partitions]
+ flash.writePartitions(readers, f)
+ data = f.getbuffer()
+ img = image.fromBytes(data)
+ for i, (p, r) in enumerate(zip(partitions, readers)):
+  if len(p) and r.offset is not None and data[r.offset:r.offset+0x200] == image.read(p, 0, 0x200):
+   img.regions['partition%d' % i] = (r.offset, len(p), cache.hashValues(p))
+ return img
 
 def writeMbr(partitions):
  f = io.BytesIO()
- mbr.writeMbr([io.BytesIO(p) for p in partitions], f)
- return f.getvalue()
+ mbr.writeMbr([image.open(p) for p in partitions], f)
+ return image.fromBytes(f.getbuffer())
+
+FS_PATTERN = re.compile(b'FAT(12|16|32)   |' + re.escape(cramfs.CRAMFS_SIGNATURE))
+FS_SIGNATURE_SIZE = len(cramfs.CRAMFS_SIGNATURE)
+
+def _getFilesystemSize(data, off):
+ head = data.read(off, off + 0x200)
+ if len(head) < 0x200:
+  return 0
+ if parse32le(head[:4]) == cramfs.CRAMFS_MAGIC and head[16:32] == cramfs.CRAMFS_SIGNATURE:
+  return parse32le(head[4:8])
+ if head[510:512] == b'\x55\xaa' and parse16le(head[11:13]) in [0x200, 0x400, 0x800, 0x1000]:
+  return (parse16le(head[19:21]) or parse32le(head[32:36])) * parse16le(head[11:13])
+ return 0
+
+def readFlash(data):
+ # Find the FAT and cramfs filesystems in a flash data area, without reading them
+ data = data if isinstance(data, image.Image) else image.Image([data])
+ matches = []
+ off = 0
+ tail = b''
+ for s in data.slices():
+  if isinstance(s, image.Fill):
+   off += s.size
+   tail = b''
+   continue
+  # Signatures spanning the end of the previous slice
+  for m in FS_PATTERN.finditer(tail + bytes(s[:FS_SIGNATURE_SIZE-1])):
+   if m.start() < len(tail) < m.end():
+    matches.append((off - len(tail) + m.start(), m))
+  matches += [(off + m.start(), m) for m in FS_PATTERN.finditer(s)]
+  tail = (tail + bytes(s[-(FS_SIGNATURE_SIZE-1):]))[-(FS_SIGNATURE_SIZE-1):]
+  off += len(s)
+
+ partitions = []
+ end = 0
+ for pos, m in sorted(matches, key=lambda m: m[0]):
+  start = pos - (0x52 if m.group(1) == b'32' else 0x36 if m.group(1) else 16)
+  if start < end or start % 0x200:
+   continue
+  size = _getFilesystemSize(data, start)
+  if size and start + size <= len(data):
+   partitions.append(image.Image(data.slices(start, start + size)))
+   end = start + size
+ return partitions
+
+def readFilesystem(data):
+ if image.read(data, 16, 32) == cramfs.CRAMFS_SIGNATURE:
+  return readCramfs(data)
+ return readFat(data)
@@ -0,0 +1,100 @@
+from collections import OrderedDict
+import concurrent.futures
+import functools
+import os
+import threading
+
+from . import cache
+
+MAX_NODES = 0x20
+
+# Most recently used nodes, shared by all tests in the process
+_nodes = OrderedDict()
+_lock = threading.RLock()
+
+# Separate from util.getExecutor, which the build steps themselves use
+_executor = concurrent.futures.ThreadPoolExecutor(os.cpu_count() or 1, 'build')
+
+def _findNodes(value):
+ if isinstance(value, Node):
+  yield value
+ elif isinstance(value, (list, tuple)):
+  for v in value:
+   yield from _findNodes(v)
+ elif isinstance(value, dict):
+  for v in value.values():
+   yield from _findNodes(v)
+
+def _getKeys(value):
+ if isinstance(value, Node):
+  return ('node', value.key)
+ elif isinstance(value, (list, tuple)):
+  return [_getKeys(v) for v in value]
+ elif isinstance(value, dict):
+  return {k: _getKeys(v) for k, v in value.items()}
+ return value
+
+def resolve(value):
+ if isinstance(value, Node):
+  return value.result()
+ elif isinstance(value, (list, tuple)):
+  return type(value)(resolve(v) for v in value)
+ elif isinstance(value, dict):
+  return {k: resolve(v) for k, v in value.items()}
+ return value
+
+
+class Node:
+ def __init__(self, key, func, args, kwargs):
+  self.key = key
+  self.future = concurrent.futures.Future()
+  deps = set(_findNodes([args, kwargs]))
+  remaining = [len(deps)]
+  lock = threading.Lock()
+
+  def run():
+   try:
+    result = func(*resolve(args), **resolve(kwargs))
+   except BaseException as e:
+    self.future.set_exception(e)
+   else:
+    self.future.set_result(result)
+
+  def depDone(f):
+   with lock:
+    remaining[0] -= 1
+    ready = remaining[0] == 0
+   if ready:
+    _executor.submit(run)
+
+  if not deps:
+   _executor.submit(run)
+  for d in deps:
+   d.future.add_done_callback(depDone)
+
+ def result(self):
+  return self.future.result()
+
+
+def _forget(key, future):
+ if future.exception() is not None:
+  with _lock:
+   if key in _nodes and _nodes[key].future is future:
+    del _nodes[key]
+
+def step(func):
+ @functools.wraps(func)
+ def wrapper(self, *args, **kwargs):
+  cls = type(self)
+  key = cache.hashValues(cls.__module__, cls.__qualname__, func.__qualname__, _getKeys(args), _getKeys(kwargs))
+  with _lock:
+   node = _nodes.get(key)
+   if node is None:
+    node = _nodes[key] = Node(key, functools.partial(func, self), args, kwargs)
+    node.future.add_done_callback(functools.partial(_forget, key))
+    while len(_nodes) > MAX_NODES:
+     _nodes.popitem(False)
+   else:
+    _nodes.move_to_end(key)
+  return node
+ return wrapper
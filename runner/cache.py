@@ -0,0 +1,260 @@
+from collections import namedtuple, OrderedDict
+import functools
+import hashlib
+import inspect
+import json
+import os
+import tempfile
+import threading
+
+from . import firmware, image
+from .util import *
+
+CACHE_DIR = os.path.abspath(os.environ.get('OPENMEMORIES_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'openmemories-ci')))
+CACHE_SIZE = int(os.environ.get('OPENMEMORIES_CACHE_SIZE', 0x80000000))
+
+CachedFile = namedtuple('CachedFile', 'path')
+
+class Cache:
+ def __init__(self, dir, maxSize):
+  self.dir = dir
+  self.maxSize = maxSize
+  self._size = None
+  self._lock = threading.Lock()
+
+ def _path(self, key):
+  return os.path.join(self.dir, key[:2], key)
+
+ def get(self, key):
+  f = self.getFile(key)
+  if f is None:
+   return None
+  try:
+   with open(f.path, 'rb') as fd:
+    return fd.read()
+  except FileNotFoundError:
+   return None
+
+ def getFile(self, key):
+  if not self.maxSize:
+   return None
+  path = self._path(key)
+  try:
+   os.utime(path)
+  except FileNotFoundError:
+   return None
+  return CachedFile(path)
+
+ def put(self, key, data):
+  if not self.maxSize:
+   return
+  path = self._path(key)
+  os.makedirs(os.path.dirname(path), exist_ok=True)
+  fd, tmp = tempfile.mkstemp(prefix='.tmp', dir=os.path.dirname(path))
+  with os.fdopen(fd, 'wb') as f:
+   if not (isinstance(data, image.Image) and data.regions and self._patchRegions(key, data, tmp)):
+    for c in image.chunks(data):
+     f.write(c)
+  size = os.path.getsize(tmp)
+  if size > self.maxSize:
+   os.remove(tmp)
+   return None
+  os.replace(tmp, path)
+  self._added(path, size)
+  return CachedFile(path)
+
+ def _patchRegions(self, key, data, tmp):
+  # Start from a cached image with the same layout and rewrite only the regions that changed
+  layoutKey = _getLayoutKey(data)
+  hashes = {name: regionKey or _hashSlices(data.slices(off, off + size)) for name, (off, size, regionKey) in data.regions.items()}
+  layout = self.get(layoutKey)
+  self.put(layoutKey, json.dumps({'key': key, 'hashes': hashes}).encode())
+  if layout is None:
+   return False
+  layout = json.loads(layout)
+  base = self.getFile(layout['key'])
+  # Copying the base image costs as much as writing the new one
+  if base is None or not reflinkFile(base.path, tmp):
+   return False
+
+  changed = set(name.split('.')[0] for name, h in hashes.items() if layout['hashes'].get(name) != h)
+  with open(tmp, 'r+b') as f:
+   for name, (off, size, regionKey) in data.regions.items():
+    if name.split('.')[0] in changed:
+     f.seek(off)
+     for c in data.chunks(off, off + size):
+      f.write(c)
+  return True
+
+ def _entries(self):
+  for dir, dirs, files in os.walk(self.dir):
+   for fn in files:
+    if fn.startswith('.tmp'):
+     continue
+    path = os.path.join(dir, fn)
+    try:
+     st = os.stat(path)
+    except FileNotFoundError:
+     continue
+    yield st.st_mtime, st.st_size, path
+
+ def _remove(self, path):
+  try:
+   os.remove(path)
+  except FileNotFoundError:
+   pass
+
+ def _added(self, path, size):
+  # Only scan the directory when the tracked size goes over the limit
+  with self._lock:
+   if self._size is not None:
+    self._size += size
+   if self._size is None or self._size > self.maxSize:
+    self.evict(path)
+
+ def evict(self, keep=None):
+  entries = list(self._entries())
+  total = sum(size for mtime, size, path in entries)
+  for mtime, size, path in sorted(entries):
+   if total <= self.maxSize:
+    break
+   if path != keep:
+    self._remove(path)
+    total -= size
+  self._size = total
+
+defaultCache = Cache(CACHE_DIR, CACHE_SIZE)
+
+
+def _hashFile(path):
+ h = hashlib.sha256()
+ with open(path, 'rb') as f:
+  for chunk in iter(lambda: f.read(0x100000), b''):
+   h.update(chunk)
+ return h.digest()
+
+_fileHashes = {}
+def hashFile(path):
+ st = os.stat(path)
+ k = (os.path.abspath(path), st.st_size, st.st_mtime_ns)
+ if k not in _fileHashes:
+  _fileHashes[k] = _hashFile(path)
+ return _fileHashes[k]
+
+def hashDir(path):
+ h = hashlib.sha256()
+ for dir, dirs, files in sorted(os.walk(path)):
+  for fn in sorted(files):
+   h.update(os.path.relpath(os.path.join(dir, fn), path).encode() + b'\0')
+   h.update(hashFile(os.path.join(dir, fn)))
+ return h.digest()
+
+def hashFiles(paths):
+ h = hashlib.sha256()
+ for fn in sorted(set(paths)):
+  h.update(hashFile(fn))
+ return h.digest()
+
+def getVersion():
+ dir = os.path.dirname(__file__)
+ return hashFiles(os.path.join(dir, fn) for fn in os.listdir(dir) if fn.endswith('.py'))
+
+def getClassVersion(cls):
+ return hashFiles(inspect.getsourcefile(c) for c in cls.__mro__ if c is not object and not c.__module__.startswith('unittest'))
+
+def _hashSlices(slices):
+ h = hashlib.sha256()
+ for s in slices:
+  if isinstance(s, image.Fill):
+   h.update(b'f' + repr(s).encode() + b'\0')
+  else:
+   h.update(b'd%d\0' % len(s))
+   h.update(s)
+ return h.hexdigest()
+
+def _getLayoutKey(data):
+ # Everything outside the regions identifies the layout
+ regions = sorted((name, off, size) for name, (off, size, key) in data.regions.items())
+ gaps = []
+ start = 0
+ for name, off, size in sorted(regions, key=lambda r: r[1]):
+  gaps.append(_hashSlices(data.slices(start, off)))
+  start = max(start, off + size)
+ gaps.append(_hashSlices(data.slices(start)))
+ return hashValues('layout', len(data), regions, gaps)
+
+MAX_DATA_HASHES = 0x20
+
+# Hashes of recently hashed data, so build outputs passed on to the next step are only hashed once
+_dataHashes = OrderedDict()
+_dataLock = threading.Lock()
+
+def _hashData(data):
+ d = hashlib.sha256()
+ for c in image.chunks(data):
+  d.update(c)
+ return d.digest()
+
+def hashData(data):
+ # Only immutable data can be remembered by identity
+ if not isinstance(data, bytes) and not (isinstance(data, memoryview) and data.readonly):
+  return _hashData(data)
+ with _dataLock:
+  entry = _dataHashes.get(id(data))
+  if entry and entry[0] is data:
+   _dataHashes.move_to_end(id(data))
+   return entry[1]
+ digest = _hashData(data)
+ with _dataLock:
+  _dataHashes[id(data)] = (data, digest)
+  while len(_dataHashes) > MAX_DATA_HASHES:
+   _dataHashes.popitem(False)
+ return digest
+
+def _update(h, value):
+ if isinstance(value, CachedFile):
+  h.update(b'b' + hashFile(value.path))
+ elif isinstance(value, memoryview) and firmware.defaultStore.getPath(value):
+  h.update(b'b' + hashFile(firmware.defaultStore.getPath(value)))
+ elif isinstance(value, (bytes, bytearray, memoryview, image.Image)):
+  h.update(b'b' + hashData(value))
+ elif isinstance(value, (list, tuple)):
+  h.update(b'l%d' % len(value))
+  for v in value:
+   _update(h, v)
+ elif isinstance(value, dict):
+  _update(h, sorted(value.items()))
+ else:
+  h.update(repr(value).encode() + b'\0')
+
+def hashValues(*values):
+ h = hashlib.sha256()
+ _update(h, values)
+ return h.hexdigest()
+
+
+def _getKey(func, self, args, kwargs):
+ cls = type(self)
+ return hashValues(getVersion(), getClassVersion(cls), cls.__qualname__, func.__qualname__, [hashDir(d) for d in self.getCacheInputs()], args, kwargs)
+
+def cached(func):
+ @functools.wraps(func)
+ def wrapper(self, *args, **kwargs):
+  key = _getKey(func, self, args, kwargs)
+  data = defaultCache.get(key)
+  if data is None:
+   data = image.read(func(self, *args, **kwargs))
+   defaultCache.put(key, data)
+  return data
+ return wrapper
+
+def cachedFile(func):
+ @functools.wraps(func)
+ def wrapper(self, *args, **kwargs):
+  key = _getKey(func, self, args, kwargs)
+  f = defaultCache.getFile(key)
+  if f is None:
+   data = func(self, *args, **kwargs)
+   f = defaultCache.put(key, data) or data
+  return f
+ return wrapper
@@ -0,0 +1,203 @@
+from collections import OrderedDict
+import io
+import stat
+import threading
+import zlib
+
+from fwtool.archive import UnixFile
+
+from .util import *
+
+CRAMFS_MAGIC = 0x28cd3d45
+CRAMFS_SIGNATURE = b'Compressed ROMFS'
+CRAMFS_FLAG_FSID_VERSION_2 = 0x1
+CRAMFS_FLAG_SORTED_DIRS = 0x2
+
+SUPER_SIZE = 0x40
+INODE_SIZE = 0xc
+BLOCK_SIZE = 0x1000
+PAD_SIZE = 0x1000
+COMPRESSION_LEVEL = 9
+MAX_RUNS_SIZE = 0x4000000
+
+# Compressed runs produced by this writer, reusing one gives the same bytes as compressing again
+_runs = OrderedDict()
+_runsSize = 0
+_runsLock = threading.Lock()
+
+def _getRunSize(data, run):
+ return len(data) + len(run[1]) + 4 * len(run[0])
+
+def _getRun(data):
+ with _runsLock:
+  run = _runs.get(data)
+  if run is not None:
+   _runs.move_to_end(data)
+  return run
+
+def _putRun(data, run):
+ global _runsSize
+ with _runsLock:
+  if data in _runs:
+   return
+  _runs[data] = run
+  _runsSize += _getRunSize(data, run)
+  while _runsSize > MAX_RUNS_SIZE:
+   _runsSize -= _getRunSize(*_runs.popitem(False))
+
+def _compressBlock(data):
+ return zlib.compress(data, COMPRESSION_LEVEL)
+
+def _makeRun(blocks):
+ # Block pointers relative to the start of the pointer table, followed by the compressed blocks
+ ends = []
+ end = 4 * len(blocks)
+ for b in blocks:
+  end += len(b)
+  ends.append(end)
+ return ends, b''.join(blocks)
+
+def getRuns(datas, executor=None):
+ runs = [_getRun(data) for data in datas]
+ missing = [i for i, run in enumerate(runs) if run is None]
+ blocks = [datas[i][j:j+BLOCK_SIZE] for i in missing for j in range(0, len(datas[i]), BLOCK_SIZE)]
+ compressed = iter((executor.map if executor else map)(_compressBlock, blocks))
+ for i in missing:
+  runs[i] = _makeRun([next(compressed) for j in range(0, len(datas[i]), BLOCK_SIZE)])
+  _putRun(datas[i], runs[i])
+ return runs
+
+
+def _parseInode(data, off):
+ w0, w1, w2 = (parse32le(data[off+i:off+i+4]) for i in range(0, 12, 4))
+ return w0 & 0xffff, w0 >> 16, w1 & 0xffffff, w1 >> 24, (w2 & 0x3f) * 4, (w2 >> 6) * 4
+
+def _dumpInode(mode, uid, size, gid, namelen, offset):
+ return dump32le((mode & 0xffff) | (uid & 0xffff) << 16) + dump32le((size & 0xffffff) | (gid & 0xff) << 24) + dump32le((namelen // 4) | (offset // 4) << 6)
+
+def _readRun(data, off, size):
+ numBlocks = (size + BLOCK_SIZE - 1) // BLOCK_SIZE
+ ends = [parse32le(data[off+4*i:off+4*i+4]) for i in range(numBlocks)]
+ start = off + 4 * numBlocks
+ blocks = []
+ contents = []
+ for i, end in enumerate(ends):
+  b = bytes(data[start:end])
+  blocks.append(b)
+  contents.append(zlib.decompress(b) if b else b'\0' * min(BLOCK_SIZE, size - i * BLOCK_SIZE))
+  start = end
+ return b''.join(contents), _makeRun(blocks)
+
+def readCramfs(data, runs=None):
+ # The original compressed blocks of each file are stored in runs, if given
+ data = memoryview(data)
+ if parse32le(data[:4]) != CRAMFS_MAGIC or bytes(data[16:32]) != CRAMFS_SIGNATURE:
+  raise Exception('Invalid cramfs')
+
+ root = _parseInode(data, SUPER_SIZE)
+ mode, uid, size, gid, namelen, offset = root
+ yield UnixFile(path='/', size=0, mtime=0, mode=mode, uid=uid, gid=gid, contents=None)
+
+ dirs = [('', root)]
+ while dirs:
+  path, (mode, uid, size, gid, namelen, offset) = dirs.pop(0)
+  end = offset + size
+  while offset < end:
+   inode = _parseInode(data, offset)
+   mode, uid, size, gid, namelen, off = inode
+   name = bytes(data[offset+INODE_SIZE:offset+INODE_SIZE+namelen]).rstrip(b'\0').decode('latin1')
+   offset += INODE_SIZE + namelen
+   p = path + '/' + name
+
+   contents = None
+   if stat.S_ISDIR(mode):
+    dirs.append((p, inode))
+   elif stat.S_ISREG(mode) or stat.S_ISLNK(mode):
+    contents, run = _readRun(data, off, size)
+    if runs is not None:
+     runs[p] = run
+    contents = io.BytesIO(contents)
+   yield UnixFile(path=p, size=size, mtime=0, mode=mode, uid=uid, gid=gid, contents=contents)
+
+
+def _pad4(n):
+ return (n + 3) & ~3
+
+def writeCramfs(files, f, executor=None, sourceRuns={}):
+ # sourceRuns maps paths to (contents, run) from the source image, reused while the contents are unchanged
+ # The root directory is '/' in archives and '' here
+ files = {file.path.rstrip('/'): file for file in files}
+ files.setdefault('', UnixFile(path='', size=0, mtime=0, mode=stat.S_IFDIR | 0o755, uid=0, gid=0, contents=None))
+ children = {'': []}
+ for path in sorted(files):
+  parent = ''
+  for name in path.split('/')[1:]:
+   p = parent + '/' + name
+   if p not in children:
+    if p not in files:
+     files[p] = UnixFile(path=p, size=0, mtime=0, mode=stat.S_IFDIR | 0o755, uid=0, gid=0, contents=None)
+    children[parent].append(name)
+    children[p] = []
+   parent = p
+
+ # Directory listings in breadth-first order, starting right after the superblock
+ order = ['']
+ dirOffsets = {}
+ dirSizes = {}
+ offset = SUPER_SIZE + INODE_SIZE
+ for dir in order:
+  names = sorted(children[dir], key=lambda n: n.encode('latin1'))
+  children[dir] = names
+  dirSizes[dir] = sum(INODE_SIZE + _pad4(len(n.encode('latin1'))) for n in names)
+  dirOffsets[dir] = offset if names else 0
+  offset += dirSizes[dir]
+  order += [dir + '/' + n for n in names if stat.S_ISDIR(files[dir + '/' + n].mode)]
+
+ # File data
+ dataFiles = []
+ for dir in order:
+  for n in children[dir]:
+   file = files[dir + '/' + n]
+   if (stat.S_ISREG(file.mode) or stat.S_ISLNK(file.mode)) and file.contents:
+    file.contents.seek(0)
+    contents = file.contents.read()
+    if contents:
+     dataFiles.append((file.path, contents))
+
+ reused = {p: sourceRuns[p][1] for p, c in dataFiles if p in sourceRuns and sourceRuns[p][0] == c}
+ compressed = iter(getRuns([c for p, c in dataFiles if p not in reused], executor))
+ dataOffsets = {}
+ runs = []
+ for path, contents in dataFiles:
+  ends, blocks = reused[path] if path in reused else next(compressed)
+  run = b''.join(dump32le(offset + e) for e in ends) + blocks
+  dataOffsets[path] = (offset, len(contents))
+  runs.append(run.ljust(_pad4(len(run)), b'\0'))
+  offset += len(runs[-1])
+ size = (offset + PAD_SIZE - 1) // PAD_SIZE * PAD_SIZE
+
+ def inode(path, name=b''):
+  file = files[path]
+  if stat.S_ISDIR(file.mode):
+   s, o = dirSizes[path], dirOffsets[path]
+  elif stat.S_ISREG(file.mode) or stat.S_ISLNK(file.mode):
+   o, s = dataOffsets.get(path, (0, 0))
+  else:
+   s, o = file.size, 0
+  return _dumpInode(file.mode, file.uid, s, file.gid, len(name), o) + name
+
+ out = bytearray()
+ out += dump32le(CRAMFS_MAGIC) + dump32le(size) + dump32le(CRAMFS_FLAG_FSID_VERSION_2 | CRAMFS_FLAG_SORTED_DIRS) + dump32le(0)
+ out += CRAMFS_SIGNATURE
+ out += dump32le(0) + dump32le(0) + dump32le(sum((s + BLOCK_SIZE - 1) // BLOCK_SIZE for o, s in dataOffsets.values())) + dump32le(len(files))
+ out += b'Compressed'.ljust(16, b'\0')
+ out += inode('')
+ for dir in order:
+  for n in children[dir]:
+   name = n.encode('latin1')
+   out += inode(dir + '/' + n, name.ljust(_pad4(len(name)), b'\0'))
+ for r in runs:
+  out += r
+ out += b'\0' * (size - len(out))
+ out[32:36] = dump32le(zlib.crc32(out))
+ f.write(out)
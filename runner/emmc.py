@@ -1,12 +1,16 @@
-import io
+from . import image
 
 BOOT_SIZE = 0x40000
 
 def writeEmmc(boot, data, size):
- f = io.BytesIO()
+ f = image.Image()
  f.write(boot)
- f.write(b'\0' * (BOOT_SIZE - f.tell()))
- f.write(b'\0' * BOOT_SIZE)
+ f.pad(BOOT_SIZE, b'\0')
+ f.fill(BOOT_SIZE, b'\0')
  f.write(data)
- f.write(b'\xff' * (2 * BOOT_SIZE + size - f.tell()))
- return f.getvalue()
+ f.pad(2 * BOOT_SIZE + size)
+ return f
+
+def readEmmc(data):
+ data = memoryview(data).cast('B')
+ return image.Image([data[:BOOT_SIZE]]), image.Image([data[2*BOOT_SIZE:]])
@@ -0,0 +1,25 @@
+import os
+import threading
+
+from .util import *
+
+class FirmwareStore:
+ def __init__(self):
+  self._views = {}
+  self._paths = {}
+  self._lock = threading.Lock()
+
+ def read(self, path):
+  path = os.path.abspath(path)
+  with self._lock:
+   if path not in self._views:
+    view = mapFile(path)
+    self._views[path] = view
+    self._paths[id(view)] = path
+   return self._views[path]
+
+ def getPath(self, view):
+  path = self._paths.get(id(view))
+  return path if path and self._views[path] is view else None
+
+defaultStore = FirmwareStore()
@@ -0,0 +1,149 @@
+import bisect
+from collections import namedtuple
+import io
+
+CHUNK_SIZE = 0x100000
+
+Fill = namedtuple('Fill', 'size, byte')
+
+class Image:
+ def __init__(self, segments=[]):
+  self.segments = []
+  self._offsets = []
+  self._size = 0
+  self.regions = {}
+  for s in segments:
+   self.write(s)
+
+ def __len__(self):
+  return self._size
+
+ def tell(self):
+  return self._size
+
+ def _append(self, segment, size):
+  if size > 0:
+   self._offsets.append(self._size)
+   self.segments.append(segment)
+   self._size += size
+
+ def write(self, data):
+  if isinstance(data, Image):
+   for name, (off, size, key) in data.regions.items():
+    self.regions[name] = (self._size + off, size, key)
+   for s in data.segments:
+    self.write(s)
+  elif isinstance(data, Fill):
+   self.fill(data.size, data.byte)
+  else:
+   data = memoryview(data).cast('B')
+   self._append(data, len(data))
+
+ def fill(self, size, byte=b'\xff'):
+  if size <= 0:
+   return
+  if self.segments and isinstance(self.segments[-1], Fill) and self.segments[-1].byte == byte:
+   self._size -= self.segments[-1].size
+   size += self.segments[-1].size
+   self.segments.pop()
+   self._offsets.pop()
+  self._append(Fill(size, byte), size)
+
+ def pad(self, size, byte=b'\xff'):
+  self.fill(size - self._size, byte)
+
+ def addSpareRegions(self, blockSize, spareOffset, spareSize):
+  # Add the spare bytes of the blocks covered by each region as a region of its own
+  for name, (off, size, key) in list(self.regions.items()):
+   start, end = off // blockSize, (off + size + blockSize - 1) // blockSize
+   self.regions[name + '.spare'] = (spareOffset + start * spareSize, (end - start) * spareSize, None)
+
+ def slices(self, start=0, end=None):
+  end = self._size if end is None else min(end, self._size)
+  i = max(bisect.bisect_right(self._offsets, start) - 1, 0)
+  while start < end and i < len(self.segments):
+   s = self.segments[i]
+   off = start - self._offsets[i]
+   size = min((s.size if isinstance(s, Fill) else len(s)) - off, end - start)
+   yield Fill(size, s.byte) if isinstance(s, Fill) else s[off:off+size]
+   start += size
+   i += 1
+
+ def chunks(self, start=0, end=None):
+  for s in self.slices(start, end):
+   if isinstance(s, Fill):
+    for j in range(0, s.size, CHUNK_SIZE):
+     yield s.byte * min(CHUNK_SIZE, s.size - j)
+   else:
+    yield s
+
+ def read(self, start=0, end=None):
+  return b''.join(self.chunks(start, end))
+
+ def getvalue(self):
+  return self.read()
+
+ def writeTo(self, f):
+  for c in self.chunks():
+   f.write(c)
+
+ def open(self):
+  return ImageReader(self)
+
+
+class ImageReader(io.RawIOBase):
+ def __init__(self, image):
+  self.image = image
+  self.pos = 0
+
+ def readable(self):
+  return True
+
+ def seekable(self):
+  return True
+
+ def tell(self):
+  return self.pos
+
+ def seek(self, offset, whence=io.SEEK_SET):
+  if whence == io.SEEK_CUR:
+   offset += self.pos
+  elif whence == io.SEEK_END:
+   offset += len(self.image)
+  self.pos = max(offset, 0)
+  return self.pos
+
+ def readinto(self, b):
+  n = 0
+  for c in self.image.chunks(self.pos, self.pos + len(b)):
+   b[n:n+len(c)] = c
+   n += len(c)
+  self.pos += n
+  return n
+
+
+def fromBytes(data):
+ data = memoryview(data).cast('B')
+ byte = bytes(data[-1:])
+ end = len(data)
+ while end > 0:
+  chunk = data[max(end - CHUNK_SIZE, 0):end]
+  if chunk != byte * len(chunk):
+   end -= len(chunk) - len(chunk.tobytes().rstrip(byte))
+   break
+  end -= len(chunk)
+ if len(data) - end < CHUNK_SIZE:
+  return Image([data])
+ return Image([data[:end], Fill(len(data) - end, byte)])
+
+def chunks(data):
+ return data.chunks() if isinstance(data, Image) else [data]
+
+def open(data):
+ return data.open() if isinstance(data, Image) else io.BytesIO(data)
+
+def read(data, start=0, end=None):
+ return data.read(start, end) if isinstance(data, Image) else bytes(data[start:end])
+
+def getvalue(data):
+ return data.getvalue() if isinstance(data, Image) else data
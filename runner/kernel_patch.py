@@ -1,24 +1,209 @@
+from array import array
+import bisect
+import functools
+import json
+import re
+import sys
+
 from capstone import *
 from capstone.arm import *
 
+from . import cache, patch
 from .util import *
 
-def getKernelBase(kernel):
+MAX_FUNCTION_SIZE = 0x400
+MAX_ALIGN = 0x10
+MAX_MARKERS = 0x1000
+
+# kallsyms_token_table entries for '0' to '9'
+KALLSYMS_DIGITS = b''.join(b'%d\0' % i for i in range(10))
+
+# mov(s) r10, r5
+PATTERN_MOV_R10_R5 = re.compile(b'\x05\xa0[\xa0\xb0]\xe1')
+
+def _array32le(data):
+ a = array('I', data)
+ if sys.byteorder != 'little':
+  a.byteswap()
+ return a
+
+def _disasm(code, offset, detail=False):
  md = Cs(CS_ARCH_ARM, CS_MODE_ARM)
- md.detail = True
+ md.detail = detail
+ return md.disasm(code, offset)
+
+def _findAligned(pattern, data):
+ return (m.start() for m in pattern.finditer(data) if m.start() % 4 == 0)
+
+def _cached(func):
+ @functools.lru_cache(8)
+ def cachedFunc(kernel):
+  key = cache.hashValues(cache.getVersion(), __name__, func.__name__, kernel)
+  data = cache.defaultCache.get(key)
+  if data is not None:
+   return json.loads(data)
+  result = func(kernel)
+  cache.defaultCache.put(key, json.dumps(result).encode())
+  return result
+
+ @functools.wraps(func)
+ def wrapper(kernel):
+  return cachedFunc(bytes(kernel))
+ return wrapper
+
+
+class SymbolIndex:
+ def __init__(self, addresses, names):
+  self.addresses = array('I', addresses)
+  self.names = names
+  self._byName = None
+
+ @classmethod
+ def parse(cls, data):
+  num = parse32le(data[:4])
+  addresses = _array32le(data[4:4+4*num])
+  return cls(addresses, data[4+4*num:].decode('latin1').split('\n') if num else [])
+
+ def dump(self):
+  return dump32le(len(self.addresses)) + b''.join(dump32le(a) for a in self.addresses) + '\n'.join(self.names).encode('latin1')
+
+ def lookup(self, name):
+  if self._byName is None:
+   self._byName = {}
+   for addr, n in zip(self.addresses, self.names):
+    self._byName.setdefault(n[1:], addr)
+  return self._byName.get(name)
+
+ def symbolize(self, addr):
+  i = bisect.bisect_right(self.addresses, addr) - 1
+  if i < 0:
+   return None
+  return self.names[i][1:], addr - self.addresses[i]
+
+
+def _skipPadding(data, off, end):
+ # Skip up to MAX_ALIGN zero bytes of alignment padding
+ for i in range(off, min(off + MAX_ALIGN, end) + 1):
+  if i % 4 == 0:
+   yield i
+  if i < len(data) and data[i] != 0:
+   break
+
+def _readTokenTable(kernel, digits):
+ start = digits
+ for i in range(ord('0')):
+  prev = kernel.rfind(b'\0', 0, start - 1) + 1
+  if prev >= start - 1:
+   return None
+  start = prev
+ tokens = []
+ off = start
+ for i in range(256):
+  end = kernel.find(b'\0', off)
+  if end <= off:
+   return None
+  tokens.append(kernel[off:end])
+  off = end + 1
+ for indexOff in _skipPadding(kernel, off, len(kernel)):
+  index = [parse16le(kernel[indexOff+2*i:indexOff+2*i+2]) for i in range(256)]
+  if index == [sum(len(t) + 1 for t in tokens[:i]) for i in range(256)]:
+   return start, tokens
+ return None
+
+def _readMarkers(kernel, tableStart):
+ for end in range(tableStart, max(tableStart - MAX_ALIGN, 0), -4):
+  if any(kernel[end:tableStart]):
+   break
+  markers = []
+  off = end - 4
+  while off >= 0 and len(markers) < MAX_MARKERS:
+   value = parse32le(kernel[off:off+4])
+   if markers and value >= markers[-1]:
+    break
+   markers.append(value)
+   if value == 0:
+    yield off, markers[::-1]
+    break
+   off -= 4
+
+def _readNames(kernel, off, end, num, tokens, markers):
+ names = []
+ pos = off
+ for i in range(num):
+  if pos >= end or (i % 256 == 0 and markers[i // 256] != pos - off):
+   return None
+  length = kernel[pos]
+  names.append(b''.join(tokens[t] for t in kernel[pos+1:pos+1+length]).decode('latin1'))
+  pos += 1 + length
+ return pos, names
+
+def _readAddresses(kernel, off, num):
+ for end in range(off, max(off - MAX_ALIGN, 0), -4):
+  if any(kernel[end:off]) or end < 4 * num:
+   break
+  addresses = _array32le(kernel[end-4*num:end])
+  if all(addresses[i] <= addresses[i+1] for i in range(num - 1)):
+   return addresses
+ return None
+
+def _readKallsyms(kernel):
+ for digits in findall(KALLSYMS_DIGITS, kernel):
+  table = _readTokenTable(kernel, digits)
+  if not table:
+   continue
+  tableStart, tokens = table
+  for markersStart, markers in _readMarkers(kernel, tableStart):
+   minSyms, maxSyms = 256 * (len(markers) - 1) + 1, 256 * len(markers)
+
+   # Find kallsyms_num_syms followed by kallsyms_names
+   for off in range(markersStart - 4, max(markersStart - maxSyms * 0x100, 0), -4):
+    num = parse32le(kernel[off:off+4])
+    if not minSyms <= num <= maxSyms:
+     continue
+    for namesStart in _skipPadding(kernel, off + 4, markersStart):
+     names = _readNames(kernel, namesStart, markersStart, num, tokens, markers)
+     if not names or markersStart not in _skipPadding(kernel, names[0], markersStart):
+      continue
+     addresses = _readAddresses(kernel, off, num)
+     if addresses:
+      return SymbolIndex(addresses, names[1])
+ return None
 
+@functools.lru_cache(8)
+def _getSymbols(kernel):
+ key = cache.hashValues(cache.getVersion(), __name__, 'getSymbols', kernel)
+ data = cache.defaultCache.get(key)
+ if data is not None:
+  return SymbolIndex.parse(data) if data else None
+ symbols = _readKallsyms(kernel)
+ cache.defaultCache.put(key, symbols.dump() if symbols else b'')
+ return symbols
+
+def getSymbols(kernel):
+ return _getSymbols(bytes(kernel))
+
+def findSymbol(kernel, name):
+ symbols = getSymbols(kernel)
+ addr = symbols.lookup(name) if symbols else None
+ return addr - getKernelBase(kernel) if addr is not None else None
+
+
+@_cached
+def getKernelBase(kernel):
  # Analyze kernel startup entry point
- prev = None
- for i in md.disasm(kernel, 0):
-  if i.id == ARM_INS_MOV and i.operands[0].reg == ARM_REG_R10 and i.operands[1].reg == ARM_REG_R5:
-   if prev.id != ARM_INS_BL:
-    raise Exception('Cannot find branch to __lookup_processor_type')
+ for off in _findAligned(PATTERN_MOV_R10_R5, kernel):
+  insns = list(_disasm(kernel[off-4:off+4], off-4, True)) if off >= 4 else []
+  if len(insns) != 2:
+   continue
+  prev, i = insns
+  if i.id == ARM_INS_MOV and i.operands[0].reg == ARM_REG_R10 and i.operands[1].reg == ARM_REG_R5 and prev.id == ARM_INS_BL:
    off_lookup_processor_type = prev.operands[0].imm
    break
-  prev = i
+ else:
+  raise Exception('Cannot find branch to __lookup_processor_type')
 
  # Analyze __lookup_processor_type
- i = next(md.disasm(kernel[off_lookup_processor_type:], 0))
+ i = next(_disasm(kernel[off_lookup_processor_type:off_lookup_processor_type+4], 0, True))
  if i.id != ARM_INS_ADD or i.operands[1].reg != ARM_REG_PC:
   raise Exception('Cannot find add instruction in __lookup_processor_type')
  off_lookup_processor_type_data = off_lookup_processor_type + i.operands[2].imm + 8
@@ -30,10 +215,8 @@ def getKernelBase(kernel):
  return off - off_lookup_processor_type_data
 
 
-def patchConsoleEnable(kernel):
- md = Cs(CS_ARCH_ARM, CS_MODE_ARM)
- md.detail = True
-
+@_cached
+def findAmbaConsole(kernel):
  kernel_base = getKernelBase(kernel)
 
  # Find struct console amba_console:
@@ -50,14 +233,21 @@ def patchConsoleEnable(kernel):
       off_uart_console_device > kernel_base and off_uart_console_device % 4 == 0 and
       off_pl011_console_setup > kernel_base and off_pl011_console_setup % 4 == 0 and
       off_pl011_console_unblank == 0):
-   break
- else:
-  raise Exception('Cannot find struct console amba_console')
+   return i
+ raise Exception('Cannot find struct console amba_console')
+
+
+@_cached
+def findConsoleSetupStore(kernel):
+ off_pl011_console_setup = findSymbol(kernel, 'pl011_console_setup')
+ if off_pl011_console_setup is None:
+  i = findAmbaConsole(kernel)
+  off_pl011_console_setup = parse32le(kernel[i+16:i+20]) - getKernelBase(kernel)
 
  # Analyze pl011_console_setup
  bblock = 0
  stores = []
- for i in md.disasm(kernel[off_pl011_console_setup-kernel_base:], off_pl011_console_setup):
+ for i in _disasm(kernel[off_pl011_console_setup:off_pl011_console_setup+MAX_FUNCTION_SIZE], off_pl011_console_setup):
   if i.id in [ARM_INS_B, ARM_INS_BL]:
    bblock += 1
    if bblock > 1:
@@ -66,11 +256,14 @@ def patchConsoleEnable(kernel):
    stores.append(i)
  if len(stores) not in [1, 2]:
   raise Exception('Cannot analyze pl011_console_setup')
- store_txrx_enable = stores[1] if len(stores) == 2 else None
+ return [stores[1].address, stores[1].size] if len(stores) == 2 else None
+
+
+def patchConsoleEnable(kernel):
+ store_txrx_enable = findConsoleSetupStore(kernel)
 
  # Patch txrx_enable
  if store_txrx_enable:
-  off = store_txrx_enable.address - kernel_base
-  size = store_txrx_enable.size
-  kernel = kernel[:off] + b'\0' * size + kernel[off+size:]
+  off, size = store_txrx_enable
+  kernel = patch.apply(kernel, [patch.Write(off, b'\0' * size)])
  return kernel
@@ -1,6 +1,7 @@
 import io
 import math
 
+from . import image
 from .util import *
 
 PAGE_SIZE = 0x1000
@@ -39,6 +40,24 @@ def writeNandBlock0(size):
  f.write(b'\xff' * (PAGES_PER_BLOCK * SAFE_PAGE_SIZE - f.tell()))
  return f.getvalue()
 
+def _expandSafeBoot(safeBoot):
+ numPages = (len(safeBoot) + SAFE_PAGE_SIZE - 1) // SAFE_PAGE_SIZE
+ buf = bytearray(b'\xff' * (numPages * PAGE_SIZE))
+ src = memoryview(safeBoot)
+ for i in range(numPages):
+  page = src[i*SAFE_PAGE_SIZE:(i+1)*SAFE_PAGE_SIZE]
+  buf[i*PAGE_SIZE:i*PAGE_SIZE+len(page)] = page
+ return buf
+
+def _dataSpare(numBlocks):
+ # 0x46, block (be16), page (be16), padding
+ blockTemplate = b''.join((b'\x46\0\0' + dump16be(j)).ljust(EXTRA_SIZE, b'\0') for j in range(PAGES_PER_BLOCK))
+ spare = bytearray(blockTemplate * numBlocks)
+ blockIds = b''.join(dump16be(i) * PAGES_PER_BLOCK for i in range(numBlocks))
+ spare[1::EXTRA_SIZE] = blockIds[0::2]
+ spare[2::EXTRA_SIZE] = blockIds[1::2]
+ return spare
+
 def writeNand(safeBoot, normalBoot, data, size):
  numBlocks = (size + PAGES_PER_BLOCK * PAGE_SIZE - 1) // PAGE_SIZE // PAGES_PER_BLOCK
  safeBootBlocks = (len(safeBoot) + PAGES_PER_BLOCK * SAFE_PAGE_SIZE - 1) // SAFE_PAGE_SIZE // PAGES_PER_BLOCK
@@ -46,19 +65,44 @@ def writeNand(safeBoot, normalBoot, data, size):
  bootBlocks = safeBootBlocks + normalBootBlocks
  dataBlocks = (len(data) + PAGES_PER_BLOCK * PAGE_SIZE - 1) // PAGE_SIZE // PAGES_PER_BLOCK
 
- f = io.BytesIO()
- f.write(b''.join(safeBoot[i:i+SAFE_PAGE_SIZE].ljust(PAGE_SIZE, b'\xff') for i in range(0, len(safeBoot), SAFE_PAGE_SIZE)))
- f.write(b'\xff' * (safeBootBlocks * PAGES_PER_BLOCK * PAGE_SIZE - f.tell()))
+ f = image.Image()
+ f.write(_expandSafeBoot(safeBoot))
+ f.pad(safeBootBlocks * PAGES_PER_BLOCK * PAGE_SIZE)
  f.write(normalBoot)
- f.write(b'\xff' * (bootBlocks * PAGES_PER_BLOCK * PAGE_SIZE - f.tell()))
+ f.pad(bootBlocks * PAGES_PER_BLOCK * PAGE_SIZE)
  f.write(data)
- f.write(b'\xff' * (numBlocks * PAGES_PER_BLOCK * PAGE_SIZE - f.tell()))
+ f.pad(numBlocks * PAGES_PER_BLOCK * PAGE_SIZE)
+
+ spareBlocks = max(min(dataBlocks, numBlocks - bootBlocks), 0)
+ f.fill(min(bootBlocks, numBlocks) * PAGES_PER_BLOCK * EXTRA_SIZE)
+ f.write(_dataSpare(spareBlocks))
+ f.fill((numBlocks - bootBlocks - spareBlocks) * PAGES_PER_BLOCK * EXTRA_SIZE)
+ f.addSpareRegions(PAGES_PER_BLOCK * PAGE_SIZE, numBlocks * PAGES_PER_BLOCK * PAGE_SIZE, PAGES_PER_BLOCK * EXTRA_SIZE)
 
+ return f
+
+def readNand(data):
+ data = memoryview(data).cast('B')
+ blockSize = PAGES_PER_BLOCK * PAGE_SIZE
+ spareSize = PAGES_PER_BLOCK * EXTRA_SIZE
+ numBlocks = len(data) // (blockSize + spareSize)
+ spare = data[numBlocks*blockSize:]
+
+ # Map logical data blocks to physical blocks using the spare area
+ blocks = {}
  for i in range(numBlocks):
-  for j in range(PAGES_PER_BLOCK):
-   if bootBlocks <= i < bootBlocks + dataBlocks:
-    f.write((b'\x46' + dump16be(i - bootBlocks) + dump16be(j)).ljust(EXTRA_SIZE, b'\0'))
-   else:
-    f.write(b'\xff' * EXTRA_SIZE)
+  s = spare[i*spareSize:(i+1)*spareSize]
+  if s[0] == 0x46:
+   n = parse16be(s[1:3])
+   if n in blocks:
+    raise Exception('Logical block %d is mapped twice' % n)
+   blocks[n] = i
 
- return f.getvalue()
+ bootBlocks = min(blocks.values(), default=numBlocks)
+ f = image.Image()
+ for i in range(max(blocks, default=-1) + 1):
+  if i in blocks:
+   f.write(data[blocks[i]*blockSize:(blocks[i]+1)*blockSize])
+  else:
+   f.fill(blockSize)
+ return image.Image([data[:bootBlocks*blockSize]]), f
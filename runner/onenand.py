@@ -1,11 +1,13 @@
-import io
-
+from . import image
 from .util import *
 
 SECTOR_SIZE = 0x200
 SPARE_SIZE = 0x10
 SECTORS_PER_BLOCK = 0x100
 
+def _spare(marker=0xffff, bootMarker=0xffff):
+ return b'\xff\xff' + dump16le(marker) + b'\xff' * (SPARE_SIZE - 6) + dump16le(bootMarker)
+
 def writeNand(boot, data, size, maxFreeSpace=-1):
  numBlocks = size // SECTOR_SIZE // SECTORS_PER_BLOCK
  bootBlocks = (len(boot) + SECTORS_PER_BLOCK * SECTOR_SIZE - 1) // SECTOR_SIZE // SECTORS_PER_BLOCK
@@ -14,26 +16,55 @@ def writeNand(boot, data, size, maxFreeSpace=-1):
   freeBlocks = (maxFreeSpace + SECTORS_PER_BLOCK * SECTOR_SIZE - 1) // SECTOR_SIZE // SECTORS_PER_BLOCK
   dataBlocks = max(dataBlocks, numBlocks - bootBlocks - freeBlocks)
 
- f = io.BytesIO()
+ f = image.Image()
  f.write(boot)
- f.write(b'\xff' * (bootBlocks * SECTORS_PER_BLOCK * SECTOR_SIZE - f.tell()))
+ f.pad(bootBlocks * SECTORS_PER_BLOCK * SECTOR_SIZE)
  f.write(data)
- f.write(b'\xff' * (numBlocks * SECTORS_PER_BLOCK * SECTOR_SIZE - f.tell()))
+ f.pad(numBlocks * SECTORS_PER_BLOCK * SECTOR_SIZE)
+
+ emptySpare = _spare() # all 0xff
+ emptyBlock = emptySpare * SECTORS_PER_BLOCK
+ bootBlock = _spare(bootMarker=0x5555) + 2 * emptySpare + _spare(bootMarker=0xaaaa) + (SECTORS_PER_BLOCK - 4) * emptySpare
+ dataHead = 2 * _spare(marker=0) + b'\xff\xff'
+ dataTail = b'\xff' * (SPARE_SIZE - 4) + (SECTORS_PER_BLOCK - 3) * emptySpare
+
+ spare = [emptyBlock] * numBlocks
+ if bootBlocks > 0:
+  spare[0] = bootBlock
+ for i in range(bootBlocks, min(bootBlocks + dataBlocks, numBlocks)):
+  spare[i] = dataHead + dump16le(i - bootBlocks) + dataTail
+ for s in spare:
+  if s is emptyBlock:
+   f.fill(len(s))
+  else:
+   f.write(s)
+ f.addSpareRegions(SECTORS_PER_BLOCK * SECTOR_SIZE, numBlocks * SECTORS_PER_BLOCK * SECTOR_SIZE, SECTORS_PER_BLOCK * SPARE_SIZE)
 
+ return f
+
+def readNand(data):
+ data = memoryview(data).cast('B')
+ blockSize = SECTORS_PER_BLOCK * SECTOR_SIZE
+ spareSize = SECTORS_PER_BLOCK * SPARE_SIZE
+ numBlocks = len(data) // (blockSize + spareSize)
+ spare = data[numBlocks*blockSize:]
+
+ # Map logical data blocks to physical blocks using the spare area
+ blocks = {}
  for i in range(numBlocks):
-  for j in range(SECTORS_PER_BLOCK):
-   marker = 0xffff
-   bootMarker = 0xffff
-   if i == 0 and i < bootBlocks:
-    if j == 0:
-     bootMarker = 0x5555
-    elif j == 3:
-     bootMarker = 0xaaaa
-   elif bootBlocks <= i < bootBlocks + dataBlocks:
-    if j == 0 or j == 1:
-     marker = 0
-    elif j == 2:
-     marker = i - bootBlocks
-   f.write(b'\xff\xff' + dump16le(marker) + b'\xff' * (SPARE_SIZE - 6) + dump16le(bootMarker))
-
- return f.getvalue()
+  s = spare[i*spareSize:(i+1)*spareSize]
+  if s[2:4] == b'\0\0':
+   n = parse16le(s[2*SPARE_SIZE+2:2*SPARE_SIZE+4])
+   if n in blocks:
+    # The spare area has no generation counter to tell the live copy from a stale one
+    raise Exception('Logical block %d is mapped twice' % n)
+   blocks[n] = i
+
+ bootBlocks = min(blocks.values(), default=numBlocks)
+ f = image.Image()
+ for i in range(max(blocks, default=-1) + 1):
+  if i in blocks:
+   f.write(data[blocks[i]*blockSize:(blocks[i]+1)*blockSize])
+  else:
+   f.fill(blockSize)
+ return image.Image([data[:bootBlocks*blockSize]]), f
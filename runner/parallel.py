@@ -0,0 +1,153 @@
+import argparse
+from concurrent import futures
+import io
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+import traceback
+import unittest
+
+from . import qemu
+
+DURATIONS_FILE = '.test_durations.json'
+
+_logStream = None
+
+def _iterTests(suite):
+ for t in suite:
+  if isinstance(t, unittest.TestSuite):
+   yield from _iterTests(t)
+  else:
+   yield t
+
+def _initWorker(tempRoot):
+ global _logStream
+ tempfile.tempdir = tempfile.mkdtemp(prefix='worker%d-' % os.getpid(), dir=tempRoot)
+
+ _logStream = io.StringIO()
+ handler = logging.StreamHandler(_logStream)
+ handler.setFormatter(logging.Formatter('%(name)s: %(message)s'))
+ root = logging.getLogger()
+ root.handlers = [handler]
+ root.setLevel(logging.DEBUG)
+
+def _runTest(testId):
+ _logStream.seek(0)
+ _logStream.truncate()
+
+ result = unittest.TestResult()
+ t = time.monotonic()
+ unittest.defaultTestLoader.loadTestsFromName(testId).run(result)
+ duration = time.monotonic() - t
+
+ outcomes = []
+ for kind, items in [('error', result.errors), ('failure', result.failures), ('skip', result.skipped), ('expectedFailure', result.expectedFailures)]:
+  outcomes += [(kind, text) for test, text in items]
+ outcomes += [('unexpectedSuccess', None) for test in result.unexpectedSuccesses]
+ return outcomes, duration, _logStream.getvalue()
+
+
+class _TextTestResult(unittest.TextTestResult):
+ def _exc_info_to_string(self, err, test):
+  return err if isinstance(err, str) else super()._exc_info_to_string(err, test)
+
+ def addOutcomes(self, test, outcomes):
+  self.startTest(test)
+  for kind, text in outcomes:
+   if kind == 'error':
+    self.addError(test, text)
+   elif kind == 'failure':
+    self.addFailure(test, text)
+   elif kind == 'skip':
+    self.addSkip(test, text)
+   elif kind == 'expectedFailure':
+    self.addExpectedFailure(test, text)
+   elif kind == 'unexpectedSuccess':
+    self.addUnexpectedSuccess(test)
+  if not outcomes:
+   self.addSuccess(test)
+  self.stopTest(test)
+
+
+def _loadDurations(fn):
+ try:
+  with open(fn) as f:
+   return json.load(f)
+ except (OSError, ValueError):
+  return {}
+
+def _saveDurations(fn, durations):
+ with open(fn + '.tmp', 'w') as f:
+  json.dump(durations, f, indent=1, sort_keys=True)
+ os.replace(fn + '.tmp', fn)
+
+def runTests(suite, jobs=None, verbosity=1, durationsFile=DURATIONS_FILE):
+ tests = {t.id(): t for t in _iterTests(suite)}
+ durations = _loadDurations(durationsFile)
+ order = sorted(tests, key=lambda i: -durations.get(i, float('inf')))
+
+ stream = unittest.runner._WritelnDecorator(sys.stderr)
+ result = _TextTestResult(stream, True, verbosity)
+ result.startTestRun()
+ t = time.monotonic()
+
+ # Workers change the tempdir, share the checkpoints of the parent
+ os.environ['QEMU_CHECKPOINT_DIR'] = qemu.CHECKPOINT_DIR
+
+ with tempfile.TemporaryDirectory() as tempRoot:
+  with futures.ProcessPoolExecutor(jobs or os.cpu_count(), initializer=_initWorker, initargs=(tempRoot,)) as pool:
+   tasks = {pool.submit(_runTest, i): i for i in order}
+   for task in futures.as_completed(tasks):
+    testId = tasks[task]
+    try:
+     outcomes, duration, log = task.result()
+    except Exception:
+     # The worker died, e.g. from a crash in a native extension
+     outcomes, duration, log = [('error', traceback.format_exc())], durations.get(testId), ''
+    if duration is not None:
+     durations[testId] = duration
+    if log:
+     stream.write(log)
+     stream.flush()
+    result.addOutcomes(tests[testId], outcomes)
+
+ timeTaken = time.monotonic() - t
+ result.stopTestRun()
+ _saveDurations(durationsFile, durations)
+
+ result.printErrors()
+ stream.writeln(result.separator2)
+ stream.writeln('Ran %d test%s in %.3fs' % (result.testsRun, '' if result.testsRun == 1 else 's', timeTaken))
+ stream.writeln()
+
+ infos = []
+ if not result.wasSuccessful():
+  infos += ['failures=%d' % len(result.failures)] if result.failures else []
+  infos += ['errors=%d' % len(result.errors)] if result.errors else []
+ infos += ['skipped=%d' % len(result.skipped)] if result.skipped else []
+ infos += ['expected failures=%d' % len(result.expectedFailures)] if result.expectedFailures else []
+ infos += ['unexpected successes=%d' % len(result.unexpectedSuccesses)] if result.unexpectedSuccesses else []
+ stream.writeln(('OK' if result.wasSuccessful() else 'FAILED') + (' (%s)' % ', '.join(infos) if infos else ''))
+ return result
+
+
+def main():
+ parser = argparse.ArgumentParser(description='Run unittest tests in parallel worker processes')
+ parser.add_argument('-s', '--start-directory', default='.')
+ parser.add_argument('-p', '--pattern', default='test*.py')
+ parser.add_argument('-t', '--top-level-directory', default=None)
+ parser.add_argument('-j', '--jobs', type=int, default=None)
+ parser.add_argument('-v', '--verbose', dest='verbosity', action='store_const', const=2, default=1)
+ parser.add_argument('-q', '--quiet', dest='verbosity', action='store_const', const=0)
+ parser.add_argument('--durations', default=DURATIONS_FILE)
+ args = parser.parse_args()
+
+ suite = unittest.defaultTestLoader.discover(args.start_directory, args.pattern, args.top_level_directory)
+ result = runTests(suite, args.jobs, args.verbosity, args.durations)
+ sys.exit(0 if result.wasSuccessful() else 1)
+
+if __name__ == '__main__':
+ main()
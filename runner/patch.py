@@ -0,0 +1,39 @@
+class Write:
+ def __init__(self, offset, data, expected=None):
+  self.offset = offset
+  self.data = data
+  self.expected = expected
+
+ def apply(self, buf):
+  end = self.offset + len(self.data)
+  if end > len(buf):
+   raise Exception('Patch at 0x%x out of range' % self.offset)
+  if self.expected is not None and buf[self.offset:self.offset+len(self.expected)] != self.expected:
+   raise Exception('Unexpected data at 0x%x' % self.offset)
+  buf[self.offset:end] = self.data
+
+
+class Replace:
+ def __init__(self, old, new, count=None):
+  if not old:
+   raise ValueError('Empty replace pattern')
+  self.old = old
+  self.new = new
+  self.count = count
+
+ def apply(self, buf):
+  n = 0
+  i = buf.find(self.old)
+  while i != -1:
+   buf[i:i+len(self.old)] = self.new
+   n += 1
+   i = buf.find(self.old, i + len(self.new))
+  if self.count is not None and n != self.count:
+   raise Exception('Expected %d occurrences of %r, found %d' % (self.count, self.old, n))
+
+
+def apply(data, patches):
+ buf = bytearray(data)
+ for p in patches:
+  p.apply(buf)
+ return buf
@@ -1,48 +1,403 @@
+import asyncio
+import concurrent.futures
+import itertools
 import json
 import logging
 import os
 from PIL import Image
+import re
+import shlex
+import shutil
 import socket
 import tempfile
+import threading
 import time
+from . import build, cache, image
 from .subprocess import *
+from .util import *
 
-class QemuRunner(SubprocessRunner):
- SERIAL_PORT_BASE = 4321
+CHECKPOINT_DIR = os.path.abspath(os.environ.get('QEMU_CHECKPOINT_DIR', os.path.join(tempfile.gettempdir(), 'qemu-checkpoints')))
+CHECKPOINT_SIZE = int(os.environ.get('QEMU_CHECKPOINT_SIZE', 0x80000000))
+CHECKPOINT_STATE = 'state.bin'
+
+# The prompt can be matched before the next line starts
+SHELL_PROMPT = re.compile(rb'(?<=[\r\n])/ # ')
+
+AGENT_MARKER = '@agent'
+AGENT_DEVICES = ['/dev/ttyAM1', '/dev/ttyAMA1', '/dev/ttyS1']
+
+def agentScript(devices=AGENT_DEVICES):
+ # Runs each request line '<id> <command>' and frames its output with begin/end markers
+ loop = 'stty -echo; while read -r id cmd; do echo "%s-begin $id"; out=$(eval "$cmd" 2>&1); rc=$?; [ -n "$out" ] && printf \'%%s\\n\' "$out"; echo "%s-end $id $rc"; done' % (AGENT_MARKER, AGENT_MARKER)
+ return 'for tty in %s; do if (exec < $tty) 2>/dev/null; then (%s) < $tty > $tty 2>&1 & break; fi; done\n' % (' '.join(devices), loop)
+
+def _linkFile(src, dst):
+ try:
+  os.link(src, dst)
+ except OSError:
+  os.symlink(os.path.abspath(src), dst)
+
+def _writeFile(data, dst):
+ if isinstance(data, cache.CachedFile):
+  _linkFile(data.path, dst)
+ elif isinstance(data, (str, os.PathLike)):
+  cloneFile(data, dst)
+ elif hasattr(data, 'read'):
+  with open(dst, 'wb') as f:
+   shutil.copyfileobj(data, f)
+ else:
+  with open(dst, 'wb') as f:
+   for c in image.chunks(data):
+    f.write(c)
+
+def _checkpointInput(data):
+ if isinstance(data, (str, os.PathLike)):
+  return cache.CachedFile(data)
+ elif hasattr(data, 'read'):
+  return data.read()
+ return data
+
+def _addDriveSnapshot(args, files):
+ args = list(args)
+ for i in range(len(args) - 1):
+  if args[i] == '-drive' and any(o in ['file=%s' % fn for fn in files] for o in args[i+1].split(',')):
+   args[i+1] += ',snapshot=on'
+ return args
+
+def _checkpointKey(name, machine, args, files, numSerial):
+ binary = shutil.which('qemu-system-arm')
+ stat = os.stat(binary) if binary else None
+ return cache.hashValues(name, machine, args, numSerial, binary, stat and stat.st_size, stat and stat.st_mtime_ns, files)
+
+class CheckpointStore(cache.Cache):
+ def _path(self, key):
+  return os.path.join(self.dir, key)
+
+ def _entries(self):
+  try:
+   names = os.listdir(self.dir)
+  except FileNotFoundError:
+   return
+  for fn in names:
+   if fn.startswith('.tmp'):
+    continue
+   path = os.path.join(self.dir, fn)
+   try:
+    yield os.stat(path).st_mtime, _getDirSize(path), path
+   except FileNotFoundError:
+    continue
+
+ def _remove(self, path):
+  shutil.rmtree(path, ignore_errors=True)
+
+ def getDir(self, key):
+  f = self.getFile(key)
+  return f.path if f else None
+
+ def putDir(self, key, tmp):
+  size = _getDirSize(tmp)
+  if not self.maxSize or size > self.maxSize:
+   return None
+  path = self._path(key)
+  try:
+   os.rename(tmp, path)
+  except OSError:
+   return path # Saved concurrently by another runner
+  self._added(path, size)
+  return path
+
+def _getDirSize(path):
+ return sum(os.stat(os.path.join(path, fn)).st_size for fn in os.listdir(path))
+
+defaultCheckpointStore = CheckpointStore(CHECKPOINT_DIR, CHECKPOINT_SIZE)
+
+def _keyEvents(key, down):
+ return [{'type': 'key', 'data': {'key': {'type': 'qcode', 'data': key}, 'down': down}}]
+
+def _posEvents(x, y):
+ return [
+  {'type': 'abs', 'data': {'axis': 'x', 'value': int(x * 0x7fff)}},
+  {'type': 'abs', 'data': {'axis': 'y', 'value': int(y * 0x7fff)}},
+ ]
+
+def _buttonEvents(down, button='left'):
+ return [{'type': 'btn', 'data': {'button': button, 'down': down}}]
+
+class InputSequence:
+ def __init__(self):
+  self.steps = []
+
+ def _add(self, events):
+  if not self.steps or not isinstance(self.steps[-1], list):
+   self.steps.append([])
+  self.steps[-1] += events
+  return self
+
+ def pause(self, seconds):
+  if seconds > 0:
+   self.steps.append(seconds)
+  return self
+
+ def key(self, key, down):
+  return self._add(_keyEvents(key, down))
+
+ def move(self, x, y):
+  return self._add(_posEvents(x, y))
+
+ def button(self, down, button='left'):
+  return self._add(_buttonEvents(down, button))
+
+ def press(self, key, hold=0):
+  return self.key(key, True).pause(hold).key(key, False)
+
+ def click(self, x, y, hold=0, button='left'):
+  return self.move(x, y).button(True, button).pause(hold).button(False, button)
+
+
+class QmpClient:
+ def __init__(self, readFile, writeFile, log=None, timeout=10):
+  self.readFile = readFile
+  self.writeFile = writeFile
+  self.log = log
+  self.timeout = timeout
+  self._ids = itertools.count()
+  self._pending = {}
+  self._subscribers = []
+  self._lock = threading.Lock()
+  self._writeLock = threading.Lock()
+  threading.Thread(target=self._asyncRead, daemon=True).start()
+
+ def close(self):
+  self.readFile.close()
+  self.writeFile.close()
+
+ def writeLine(self, data):
+  with self._writeLock:
+   self.writeFile.write(data + '\n')
+   self.writeFile.flush()
+
+ def _asyncRead(self):
+  for l in iter(self.readFile.readline, ''):
+   if self.log:
+    self.log.debug(l.rstrip('\n'))
+   try:
+    msg = json.loads(l)
+   except ValueError:
+    continue
+   if 'event' in msg:
+    with self._lock:
+     subscribers = list(self._subscribers)
+    for name, callback in subscribers:
+     if name is None or name == msg['event']:
+      try:
+       callback(msg)
+      except Exception:
+       (self.log or logging.getLogger(__name__)).exception('QMP event callback failed')
+   elif 'id' in msg:
+    with self._lock:
+     f = self._pending.pop(msg['id'], None)
+    if f:
+     if 'error' in msg:
+      f.set_exception(Exception('QMP error: %s' % msg['error'].get('desc')))
+     else:
+      f.set_result(msg.get('return'))
+  with self._lock:
+   pending = list(self._pending.values())
+   self._pending.clear()
+  for f in pending:
+   f.set_exception(EOFError())
+
+ def _send(self, cmd, kwargs):
+  f = concurrent.futures.Future()
+  with self._lock:
+   id = next(self._ids)
+   self._pending[id] = f
+  self.writeLine(json.dumps({'execute': cmd, 'arguments': kwargs, 'id': id}))
+  return id, f
+
+ def send(self, cmd, **kwargs):
+  return self._send(cmd, kwargs)[1]
+
+ def execute(self, cmd, **kwargs):
+  id, f = self._send(cmd, kwargs)
+  try:
+   return f.result(self.timeout)
+  except concurrent.futures.TimeoutError:
+   with self._lock:
+    self._pending.pop(id, None)
+   raise TimeoutError()
 
- def __init__(self, machine, args=[], files=[], numSerial=1, timeout=10):
+ async def executeAsync(self, cmd, **kwargs):
+  return await asyncio.wait_for(asyncio.wrap_future(self.send(cmd, **kwargs)), self.timeout)
+
+ def subscribe(self, callback, name=None):
+  with self._lock:
+   self._subscribers.append((name, callback))
+
+ def unsubscribe(self, callback, name=None):
+  with self._lock:
+   self._subscribers.remove((name, callback))
+
+ def waitEvent(self, name):
+  f = concurrent.futures.Future()
+  def callback(msg):
+   if not f.done():
+    f.set_result(msg)
+  self.subscribe(callback, name)
+  try:
+   return f.result(self.timeout)
+  except concurrent.futures.TimeoutError:
+   raise TimeoutError()
+  finally:
+   self.unsubscribe(callback, name)
+
+
+class EventStream:
+ def __init__(self, readFile, writeFile, log=None, timeout=10):
+  self.readFile = readFile
+  self.writeFile = writeFile
+  self.log = log
+  self.timeout = timeout
+  self.records = []
+  self._cursor = 0
+  self._eof = False
+  self._cond = threading.Condition()
+  threading.Thread(target=self._asyncRead, daemon=True).start()
+
+ def close(self):
+  self.readFile.close()
+  self.writeFile.close()
+
+ def _asyncRead(self):
+  for l in iter(self.readFile.readline, ''):
+   if self.log:
+    self.log.debug(l.rstrip('\n'))
+   with self._cond:
+    self.records.append(l.rstrip('\r\n'))
+    self._cond.notify_all()
+  with self._cond:
+   self._eof = True
+   self._cond.notify_all()
+
+ def skip(self):
+  with self._cond:
+   self._cursor = len(self.records)
+
+ def waitForEvent(self, pattern, timeout=None):
+  pattern = re.compile(pattern)
+  deadline = time.monotonic() + (self.timeout if timeout is None else timeout)
+  with self._cond:
+   i = self._cursor
+   while True:
+    for i in range(i, len(self.records)):
+     if pattern.search(self.records[i]):
+      self._cursor = i + 1
+      return self.records[i]
+    i = len(self.records)
+    if self._eof:
+     raise EOFError()
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+     raise TimeoutError()
+    self._cond.wait(remaining)
+
+
+class CommandAgent:
+ def __init__(self, pipe):
+  self.pipe = pipe
+  self._ids = itertools.count()
+
+ def execCommands(self, cmds):
+  ids = [next(self._ids) for cmd in cmds]
+  self.pipe.writeLine('\n'.join('%d %s' % (id, cmd) for id, cmd in zip(ids, cmds)))
+  results = []
+  for id in ids:
+   self.pipe.expectLine(lambda l: l.rstrip('\r') == '%s-begin %d' % (AGENT_MARKER, id))
+   lines = []
+   for l in iter(self.pipe.readLine, None):
+    l = l.rstrip('\r')
+    if l.startswith('%s-end %d ' % (AGENT_MARKER, id)):
+     results.append(('\n'.join(lines), int(l.split()[-1])))
+     break
+    lines.append(l)
+  return results
+
+
+class QemuRunner(SubprocessRunner):
+ def __init__(self, machine, args=[], files={}, numSerial=1, timeout=10, checkpoint=None, boot=None, eventSerial=None, agentSerial=None, writableFiles=[]):
   self.tempdir = tempfile.TemporaryDirectory()
-  for fn, data in files.items():
-   with open(os.path.join(self.tempdir.name, fn), 'wb') as f:
-    f.write(data)
+  files = build.resolve(files)
+  self.files = list(files)
+  self.writableFiles = list(writableFiles)
+  self.outputFiles = {}
+
+  checkpointKey = None
+  checkpointDir = None
+  if checkpoint and defaultCheckpointStore.maxSize:
+   files = {fn: _checkpointInput(data) for fn, data in files.items()}
+   checkpointKey = _checkpointKey(checkpoint, machine, args, files, numSerial)
+   checkpointDir = defaultCheckpointStore.getDir(checkpointKey)
+  restore = checkpointDir is not None
+
+  if restore:
+   for fn in files:
+    cloneFile(os.path.join(checkpointDir, fn), os.path.join(self.tempdir.name, fn))
+   args += ['-incoming', 'exec:cat %s' % shlex.quote(os.path.join(checkpointDir, CHECKPOINT_STATE))]
+  else:
+   for fn, data in files.items():
+    if (checkpointKey or fn in self.writableFiles) and isinstance(data, cache.CachedFile):
+     # Drive state has to be saved with the checkpoint or read back later, use a private copy
+     data = data.path
+    _writeFile(data, os.path.join(self.tempdir.name, fn))
+   if not checkpointKey:
+    args = _addDriveSnapshot(args, [fn for fn, data in files.items() if isinstance(data, cache.CachedFile) and fn not in self.writableFiles])
 
   args += ['-machine', machine]
   args += ['-display', 'none']
   args += ['-qmp', 'stdio']
+  listeners = []
   for i in range(numSerial):
-   args += ['-serial', 'tcp::%d,server,mux' % (self.SERIAL_PORT_BASE + i)]
+   path = os.path.join(self.tempdir.name, 'serial%d.sock' % i)
+   l = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+   l.bind(path)
+   l.listen(1)
+   l.settimeout(timeout)
+   listeners.append(l)
+   args += ['-serial', 'unix:%s,mux' % path]
 
   super().__init__(name='qemu-system-arm', args=['qemu-system-arm']+args, cwd=self.tempdir.name, timeout=timeout, log=False)
 
   self.serial = []
-  t = time.monotonic()
-  for i in range(numSerial):
-   while True:
-    try:
-     s = socket.create_connection(('127.0.0.1', self.SERIAL_PORT_BASE + i))
-     break
-    except ConnectionError:
-     if time.monotonic() >= t + timeout:
-      raise
-     time.sleep(1)
+  for i, l in enumerate(listeners):
+   try:
+    s, addr = l.accept()
+   except socket.timeout:
+    raise TimeoutError()
+   finally:
+    l.close()
+   s.settimeout(None)
    f = s.makefile('rw')
    s.close()
-   self.serial.append(Pipe(f, f, logging.getLogger('qemu-system-arm.serial%d' % i), timeout))
+   self.serial.append((EventStream if i == eventSerial else Pipe)(f, f, logging.getLogger('qemu-system-arm.serial%d' % i), timeout))
   if numSerial:
    self.defaultPipe = self.serial[0]
+  self.events = self.serial[eventSerial] if eventSerial is not None else None
+  self.agent = CommandAgent(self.serial[agentSerial]) if agentSerial is not None else None
 
   self.execQmpCommand('qmp_capabilities')
 
+  if restore:
+   # The checkpoint was saved with the guest stopped
+   self._waitStatus(lambda s: s != 'inmigrate', 'query-status')
+   self.execQmpCommand('cont')
+  elif boot:
+   boot(self)
+   if checkpointKey:
+    self.saveCheckpoint(checkpointKey)
+
+ def createPipe(self, readFile, writeFile, log, timeout):
+  return QmpClient(readFile, writeFile, log, timeout)
+
  def close(self):
   super().close()
   for s in self.serial:
@@ -52,33 +407,93 @@ class QemuRunner(SubprocessRunner):
   if self.running():
    self.stdio.writeLine(json.dumps({'execute': 'quit'}))
   self.wait()
+  # The mappings stay valid after the tempdir is removed
+  for fn in self.writableFiles:
+   self.outputFiles[fn] = mapFile(os.path.join(self.tempdir.name, fn))
   self.tempdir.cleanup()
 
+ def _waitStatus(self, f, cmd):
+  t = time.monotonic()
+  while True:
+   status = self.execQmpCommand(cmd).get('status')
+   if f(status):
+    return status
+   if time.monotonic() >= t + self.stdio.timeout:
+    raise TimeoutError()
+   time.sleep(.05)
+
+ def saveCheckpoint(self, key, store=defaultCheckpointStore):
+  os.makedirs(store.dir, exist_ok=True)
+  tmp = tempfile.mkdtemp(prefix='.tmp', dir=store.dir)
+  try:
+   self.execQmpCommand('stop')
+   self.execQmpCommand('migrate', uri='exec:cat > %s' % shlex.quote(os.path.join(tmp, CHECKPOINT_STATE)))
+   if self._waitStatus(lambda s: s in ['completed', 'failed', 'cancelled'], 'query-migrate') != 'completed':
+    raise Exception('Cannot save checkpoint')
+   for fn in self.files:
+    cloneFile(os.path.join(self.tempdir.name, fn), os.path.join(tmp, fn))
+   store.putDir(key, tmp)
+  finally:
+   shutil.rmtree(tmp, ignore_errors=True)
+  self.execQmpCommand('cont')
+
  def execQmpCommand(self, cmd, **kwargs):
-  self.stdio.writeLine(json.dumps({'execute': cmd, 'arguments': kwargs}))
-  l = self.stdio.expectLine(lambda l: 'return' in json.loads(l))
-  return json.loads(l)['return']
+  return self.stdio.execute(cmd, **kwargs)
+
+ def sendQmpCommand(self, cmd, **kwargs):
+  return self.stdio.send(cmd, **kwargs)
 
  def execShellCommand(self, cmd):
-  self.writeLine('\n%s\n' % cmd)
-  self.expectLine(lambda l: l.replace(' \b', '') == '/ # %s' % cmd)
-  return '\n'.join(iter(self.readLine, '/ # '))
+  self.writeLine(cmd)
+  self.expectLine(lambda l: l.replace(' \b', '') in [cmd, '/ # %s' % cmd])
+  self.defaultPipe.expect(SHELL_PROMPT)
+  return '\n'.join(self.defaultPipe.before.decode('utf-8', 'replace').splitlines())
+
+ def execShellCommands(self, cmds):
+  # Returns (output, exit code) for each command
+  if self.agent:
+   return self.agent.execCommands(cmds)
+  results = []
+  for cmd in cmds:
+   output = self.execShellCommand(cmd)
+   results.append((output, int(self.execShellCommand('echo $?'))))
+  return results
+
+ def startEventStream(self, device, source='/dev/blog_fsk', interval=.2):
+  # Forward new records to the event serial port, draining the old ones
+  self.events.skip()
+  self.execShellCommand('cat %s > /dev/null; (while true; do cat %s; usleep %d; done) > %s & EVENT_PID=$!' % (source, source, interval * 1000000, device))
+
+ def stopEventStream(self):
+  self.execShellCommand('kill $EVENT_PID')
+
+ def skipEvents(self):
+  self.events.skip()
+
+ def waitForEvent(self, pattern, timeout=None):
+  return self.events.waitForEvent(pattern, timeout)
 
  def sendKey(self, key, down):
-  self.execQmpCommand('input-send-event', events=[
-   {'type': 'key', 'data': {'key': {'type': 'qcode', 'data': key}, 'down': down}},
-  ])
+  self.execQmpCommand('input-send-event', events=_keyEvents(key, down))
 
  def sendMousePos(self, x, y):
-  self.execQmpCommand('input-send-event', events=[
-   {'type': 'abs', 'data': {'axis': 'x', 'value': int(x * 0x7fff)}},
-   {'type': 'abs', 'data': {'axis': 'y', 'value': int(y * 0x7fff)}},
-  ])
+  self.execQmpCommand('input-send-event', events=_posEvents(x, y))
 
  def sendMouseButton(self, down):
-  self.execQmpCommand('input-send-event', events=[
-   {'type': 'btn', 'data': {'button': 'left', 'down': down}},
-  ])
+  self.execQmpCommand('input-send-event', events=_buttonEvents(down))
+
+ def sendInput(self, seq):
+  futures = []
+  for step in seq.steps:
+   if isinstance(step, list):
+    futures.append(self.sendQmpCommand('input-send-event', events=step))
+   else:
+    time.sleep(step)
+  for f in futures:
+   try:
+    f.result(self.stdio.timeout)
+   except concurrent.futures.TimeoutError:
+    raise TimeoutError()
 
  def screenshot(self):
   fn = 'screen.ppm'
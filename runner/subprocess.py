@@ -1,15 +1,19 @@
 import logging
-import queue
+import re
 import subprocess
 import sys
 import threading
+import time
 
 class SubprocessRunner:
  def __init__(self, name, args, cwd=None, timeout=10, log=True):
   self.p = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, cwd=cwd, universal_newlines=True)
-  self.stdio = Pipe(self.p.stdout, self.p.stdin, logging.getLogger(name + '.stdio') if log else None, timeout)
+  self.stdio = self.createPipe(self.p.stdout, self.p.stdin, logging.getLogger(name + '.stdio') if log else None, timeout)
   self.defaultPipe = self.stdio
 
+ def createPipe(self, readFile, writeFile, log, timeout):
+  return Pipe(readFile, writeFile, log, timeout)
+
  def running(self):
   return self.p.poll() is None
 
@@ -30,11 +34,11 @@ class SubprocessRunner:
  def __exit__(self, type, value, traceback):
   self.finish()
 
- def readLine(self):
-  return self.defaultPipe.readLine()
+ def readLine(self, timeout=None):
+  return self.defaultPipe.readLine(timeout)
 
- def expectLine(self, f):
-  return self.defaultPipe.expectLine(f)
+ def expectLine(self, f, timeout=None):
+  return self.defaultPipe.expectLine(f, timeout)
 
  def writeLine(self, data):
   self.defaultPipe.writeLine(data)
@@ -45,13 +49,34 @@ class PythonRunner(SubprocessRunner):
   super().__init__(name=script, args=[sys.executable, '-u', '-m', script]+args, timeout=timeout, log=log)
 
 
+# Line endings as in universal newlines mode. A trailing '\r' waits for a possible '\n'.
+LINE_PATTERN = re.compile(rb'\r\n|\n|\r(?!\n|\Z)')
+BUFFER_COMPACT_SIZE = 0x10000
+
+def _compile(pattern):
+ if isinstance(pattern, str):
+  pattern = pattern.encode()
+ if isinstance(pattern, (bytes, bytearray)):
+  return re.compile(re.escape(pattern))
+ if isinstance(pattern, (list, tuple, set, frozenset)):
+  return re.compile(b'|'.join(re.escape(p.encode() if isinstance(p, str) else p) for p in sorted(pattern, key=len, reverse=True)))
+ return pattern
+
+def _decode(data):
+ return data.decode('utf-8', 'replace')
+
 class Pipe:
  def __init__(self, readFile, writeFile, log=None, timeout=10):
   self.readFile = readFile
   self.writeFile = writeFile
   self.log = log
   self.timeout = timeout
-  self.q = queue.Queue()
+  self.before = b''
+  self._buf = bytearray()
+  self._pos = 0
+  self._logPos = 0
+  self._eof = False
+  self._cond = threading.Condition()
   threading.Thread(target=self._asyncRead, daemon=True).start()
 
  def close(self):
@@ -59,25 +84,74 @@ class Pipe:
   self.writeFile.close()
 
  def _asyncRead(self):
+  f = getattr(self.readFile, 'buffer', self.readFile)
   while True:
-   l = self.readFile.readline()
-   self.q.put(l)
-   if l == '':
-    break
-   if self.log:
-    self.log.debug(l.rstrip('\n'))
-
- def readLine(self):
+   try:
+    data = f.read1(0x10000)
+   except (OSError, ValueError):
+    data = b''
+   with self._cond:
+    if not data:
+     self._eof = True
+     self._cond.notify_all()
+     break
+    self._buf += data
+    if self.log:
+     for m in iter(lambda: LINE_PATTERN.search(self._buf, self._logPos), None):
+      self.log.debug(_decode(self._buf[self._logPos:m.start()]))
+      self._logPos = m.end()
+    self._cond.notify_all()
+
+ def _consume(self, end, next):
+  self.before = bytes(self._buf[self._pos:end])
+  self._pos = next
+  # Keep one byte before the position for lookbehind assertions
+  pos = (min(self._pos, self._logPos) if self.log else self._pos) - 1
+  if pos > BUFFER_COMPACT_SIZE and pos > len(self._buf) // 2:
+   # Replace rather than resize, match objects still refer to the old buffer
+   self._buf = self._buf[pos:]
+   self._pos -= pos
+   self._logPos = max(self._logPos - pos, 0)
+
+ def expectAny(self, patterns, timeout=None):
+  patterns = [_compile(p) for p in patterns]
+  deadline = time.monotonic() + (self.timeout if timeout is None else timeout)
+  with self._cond:
+   while True:
+    best = None
+    for i, p in enumerate(patterns):
+     m = p.search(self._buf, self._pos)
+     if m and (best is None or m.start() < best[1].start()):
+      best = i, m
+    if best:
+     self._consume(best[1].start(), best[1].end())
+     return best
+    if self._eof:
+     raise EOFError()
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+     raise TimeoutError()
+    self._cond.wait(remaining)
+
+ def expect(self, pattern, timeout=None):
+  return self.expectAny([pattern], timeout)[1]
+
+ def readLine(self, timeout=None):
   try:
-   l = self.q.get(timeout=self.timeout)
-  except queue.Empty:
-   raise TimeoutError()
-  if l == '':
-   raise EOFError()
-  return l.rstrip('\n')
-
- def expectLine(self, f):
-  return next(l for l in iter(self.readLine, None) if f(l))
+   self.expect(LINE_PATTERN, timeout)
+  except EOFError:
+   with self._cond:
+    if self._pos == len(self._buf):
+     raise
+    self._consume(len(self._buf), len(self._buf))
+  return _decode(self.before)
+
+ def expectLine(self, f, timeout=None):
+  deadline = time.monotonic() + (self.timeout if timeout is None else timeout)
+  while True:
+   l = self.readLine(max(deadline - time.monotonic(), 0))
+   if f(l):
+    return l
 
  def writeLine(self, data):
   self.writeFile.write(data + '\n')
@@ -1,4 +1,12 @@
+import atexit
+import concurrent.futures
+import fcntl
+import mmap
+import multiprocessing
+import os
+import shutil
 import struct
+import threading
 
 def parse32be(data):
  return struct.unpack('>I', data)[0]
@@ -35,3 +43,40 @@ def findall(p, s):
  while i != -1:
   yield i
   i = s.find(p, i+1)
+
+_executor = None
+def getExecutor():
+ global _executor
+ if not _executor and (os.cpu_count() or 1) > 1:
+  _executor = concurrent.futures.ThreadPoolExecutor(os.cpu_count())
+ return _executor
+
+_processExecutor = None
+_processLock = threading.Lock()
+def getProcessExecutor():
+ # For pure Python work, which holds the GIL
+ global _processExecutor
+ with _processLock:
+  if not _processExecutor and (os.cpu_count() or 1) > 1:
+   _processExecutor = concurrent.futures.ProcessPoolExecutor(os.cpu_count(), multiprocessing.get_context('spawn'))
+   atexit.register(_processExecutor.shutdown)
+ return _processExecutor
+
+FICLONE = 0x40049409
+
+def reflinkFile(src, dst):
+ with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+  try:
+   fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+  except OSError:
+   return False
+ return True
+
+def cloneFile(src, dst):
+ if not reflinkFile(src, dst):
+  shutil.copyfile(src, dst)
+
+def mapFile(path):
+ with open(path, 'rb') as f:
+  data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(f.fileno()).st_size else b''
+ return memoryview(data)
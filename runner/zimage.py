@@ -1,23 +1,96 @@
+import functools
+import threading
 import zlib
 import zopfli.gzip
 
-def _unpack(data):
- offset = data.find(b'\x1f\x8b\x08\x00')
- decomp = zlib.decompressobj(wbits=31)
- kernel = decomp.decompress(data[offset:]) + decomp.flush()
- size = len(data) - offset - len(decomp.unused_data)
- return offset, size, kernel
+from . import cache, patch
+from .util import *
 
-def _pack(data):
- return zopfli.gzip.compress(data, numiterations=1, blocksplitting=False)
+# Compression strategies, from fastest to smallest output. Each group is tried concurrently.
+STRATEGIES = [
+ [('zlib', 6), ('zlib', 9)],
+ [('zopfli', 1)],
+ [('zopfli', 5), ('zopfli', 15)],
+]
+
+CHUNK_SIZE = 0x10000
+
+class ZImage:
+ def __init__(self, data):
+  self.data = data
+  self.offset = data.find(b'\x1f\x8b\x08\x00')
+  if self.offset < 0:
+   raise Exception('Cannot find compressed kernel')
+  self._decomp = zlib.decompressobj(wbits=31)
+  self._pos = self.offset
+  self._kernel = bytearray()
+  self._size = None
+  self._lock = threading.Lock()
+
+ def _inflate(self, end=None):
+  with self._lock:
+   while self._size is None and (end is None or len(self._kernel) < end):
+    chunk = self.data[self._pos:self._pos+CHUNK_SIZE]
+    self._pos += len(chunk)
+    self._kernel += self._decomp.decompress(chunk)
+    if self._decomp.eof or not chunk:
+     self._kernel += self._decomp.flush()
+     self._size = self._pos - self.offset - len(self._decomp.unused_data)
+     self._kernel = bytes(self._kernel)
+
+ @property
+ def size(self):
+  self._inflate()
+  return self._size
+
+ @property
+ def kernel(self):
+  self._inflate()
+  return self._kernel
+
+ def read(self, start, end):
+  self._inflate(end)
+  return bytes(self._kernel[start:end])
+
+ def patch(self, patches):
+  kernel = patches(self.kernel) if callable(patches) else patch.apply(self.kernel, patches)
+  compressed = _pack(kernel, self.size)
+  return patch.apply(self.data, [patch.Write(self.offset, compressed.ljust(self.size, b'\0'))])
+
+@functools.lru_cache(8)
+def _getZimage(data):
+ return ZImage(data)
+
+def getZimage(data):
+ return _getZimage(bytes(data))
+
+def _compress(data, strategy):
+ method, level = strategy
+ if method == 'zlib':
+  c = zlib.compressobj(level, zlib.DEFLATED, 31)
+  return c.compress(data) + c.flush()
+ elif method == 'zopfli':
+  return zopfli.gzip.compress(data, numiterations=level, blocksplitting=False)
+ else:
+  raise Exception('Unknown compression method')
+
+def _pack(data, size):
+ key = cache.hashValues(__name__, STRATEGIES, data, size)
+ compressed = cache.defaultCache.get(key)
+ if compressed is not None:
+  return compressed
+
+ executor = getExecutor()
+ for group in STRATEGIES:
+  results = executor.map(lambda s: _compress(data, s), group) if executor else (_compress(data, s) for s in group)
+  compressed = next((c for c in results if len(c) <= size), None)
+  if compressed is not None:
+   cache.defaultCache.put(key, compressed)
+   return compressed
+ raise Exception('Compressed kernel does not fit')
 
 def unpackZimage(data):
- offset, size, kernel = _unpack(data)
- return kernel
-
-def patchZimage(data, func):
- offset, size, kernel = _unpack(data)
- compressed = _pack(func(kernel))
- if len(compressed) > size:
-  raise Exception('Compressed kernel does not fit')
- return data[:offset] + compressed.ljust(size, b'\0') + data[offset+size:]
+ return getZimage(data).kernel
+
+def patchZimage(data, patches):
+ return getZimage(data).patch(patches)
@@ -2,6 +2,8 @@ import logging
 import unittest
 
 class TestCase(unittest.TestCase):
+ BOOT_TIMEOUT = 120
+
  def __init__(self, methodName):
   super().__init__(methodName)
   self.log = logging.getLogger(self.__class__.__name__)
@@ -9,3 +11,6 @@ class TestCase(unittest.TestCase):
 
  def setUp(self):
   self.log.info('Starting test\n\n%s\n#\n# %s.%s\n#\n%s\n', '#'*80, self.__class__.__name__, self._testMethodName, '#'*80)
+
+ def getCacheInputs(self):
+  return [getattr(self, a) for a in ['FIRMWARE_DIR', 'FIRMWARE_DUMP_DIR'] if hasattr(self, a)]
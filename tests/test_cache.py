@@ -0,0 +1,59 @@
+import os
+import shutil
+import tempfile
+import unittest.mock
+
+from . import TestCase
+from runner import cache, image
+
+class TestCache(TestCase):
+ def setUp(self):
+  super().setUp()
+  self.tempdir = tempfile.TemporaryDirectory()
+  self.addCleanup(self.tempdir.cleanup)
+
+ def testEvict(self):
+  c = cache.Cache(self.tempdir.name, 100)
+  a = c.put('aa', b'a' * 60)
+  os.utime(a.path, (0, 0))
+  b = c.put('bb', b'b' * 60)
+  self.assertFalse(os.path.exists(a.path))
+  self.assertEqual(c.get('bb'), b'b' * 60)
+  self.assertIsNone(c.put('cc', b'c' * 200))
+  self.assertIsNone(c.get('cc'))
+  self.assertTrue(os.path.exists(b.path))
+
+ def testPatchRegions(self):
+  c = cache.Cache(self.tempdir.name, 0x10000)
+  def makeImage(part, key=None):
+   img = image.Image([b'head', part, b'tail'])
+   img.regions = {'partition0': (4, len(part), key)}
+   return img
+  def reflinkFile(src, dst):
+   shutil.copyfile(src, dst)
+   return True
+  with unittest.mock.patch.object(cache, 'reflinkFile', reflinkFile):
+   c.put('k1', makeImage(b'aaaa', 'a'))
+   c.put('k2', makeImage(b'bbbb', 'b'))
+   self.assertEqual(c.get('k2'), b'headbbbbtail')
+   # Regions with the same input key are not rewritten
+   c.put('k3', makeImage(b'cccc', 'b'))
+   self.assertEqual(c.get('k3'), b'headbbbbtail')
+  self.assertEqual(c.get('k1'), b'headaaaatail')
+
+  # Without reflink, the whole image is written
+  with unittest.mock.patch.object(cache, 'reflinkFile', return_value=False):
+   img = makeImage(b'dddd')
+   c.put('k4', img)
+  self.assertEqual(c.get('k4'), img.getvalue())
+
+ def testCachedType(self):
+  class Test:
+   def getCacheInputs(self):
+    return []
+   @cache.cached
+   def prepare(self):
+    return image.Image([b'abc'])
+  with unittest.mock.patch.object(cache, 'defaultCache', cache.Cache(self.tempdir.name, 0x10000)):
+   self.assertEqual(Test().prepare(), b'abc')
+   self.assertEqual(Test().prepare(), b'abc')
@@ -0,0 +1,48 @@
+import collections
+import io
+import os
+import stat
+import unittest.mock
+
+from fwtool.archive import UnixFile
+
+from . import TestCase
+from runner import archive, cramfs
+
+class TestCramfs(TestCase):
+ def writeCramfs(self, files):
+  f = io.BytesIO()
+  cramfs.writeCramfs(files, f)
+  return f.getvalue()
+
+ def testRoundTrip(self):
+  files = [
+   UnixFile(path='/', size=0, mtime=0, mode=stat.S_IFDIR | 0o700, uid=1, gid=2, contents=None),
+   UnixFile(path='/bin/big', size=0, mtime=0, mode=stat.S_IFREG | 0o755, uid=0, gid=0, contents=io.BytesIO(os.urandom(0x1800) + b'a' * 0x2000)),
+   UnixFile(path='/etc/empty', size=0, mtime=0, mode=stat.S_IFREG | 0o644, uid=0, gid=0, contents=io.BytesIO(b'')),
+   UnixFile(path='/sh', size=0, mtime=0, mode=stat.S_IFLNK | 0o777, uid=0, gid=0, contents=io.BytesIO(b'/bin/big')),
+  ]
+  data = self.writeCramfs(files)
+  read = {f.path: f for f in cramfs.readCramfs(data)}
+  self.assertEqual(sorted(read), ['/', '/bin', '/bin/big', '/etc', '/etc/empty', '/sh'])
+  self.assertEqual((read['/'].mode, read['/'].uid, read['/'].gid), (stat.S_IFDIR | 0o700, 1, 2))
+  for f in files[1:]:
+   f.contents.seek(0)
+   self.assertEqual(read[f.path].mode, f.mode)
+   self.assertEqual(read[f.path].contents.read() if read[f.path].contents else b'', f.contents.read())
+
+  # Output must not depend on what was compressed before
+  with unittest.mock.patch.object(cramfs, '_runs', collections.OrderedDict()):
+   self.assertEqual(self.writeCramfs(read.values()), data)
+
+ def testReuseSourceBlocks(self):
+  files = [
+   UnixFile(path='/a', size=0, mtime=0, mode=stat.S_IFREG | 0o644, uid=0, gid=0, contents=io.BytesIO(os.urandom(0x3000))),
+   UnixFile(path='/b', size=0, mtime=0, mode=stat.S_IFREG | 0o644, uid=0, gid=0, contents=io.BytesIO(b'b')),
+  ]
+  source = archive.readCramfs(self.writeCramfs(files))
+  source.write('/b', b'patched')
+  with unittest.mock.patch.object(cramfs, '_compressBlock', side_effect=cramfs._compressBlock) as compress:
+   data = archive.writeCramfs(source, False)
+  compress.assert_called_once_with(b'patched')
+  self.assertEqual(archive.readCramfs(data).read('/a'), source.read('/a'))
@@ -5,16 +5,16 @@ import textwrap
 import time
 
 from . import TestCase
-from runner import archive, kernel_patch, onenand, qemu, zimage
+from runner import archive, build, cache, firmware, kernel_patch, onenand, patch, qemu, zimage
 
 
 class FirmwareDump:
  def __init__(self, dir):
   self._dir = dir
+  self._partitions = {}
 
  def _readFile(self, name, dir=None):
-  with open(os.path.join(dir or self._dir, name), 'rb') as f:
-   return f.read()
+  return firmware.defaultStore.read(os.path.join(dir or self._dir, name))
 
  def getBootRom(self):
   return self._readFile('bootrom')
@@ -23,6 +23,11 @@ class FirmwareDump:
   return self._readFile('boot')
 
  def getPartition(self, i):
+  if i not in self._partitions:
+   self._partitions[i] = self._readPartition(i).freeze()
+  return archive.Archive.thaw(self._partitions[i])
+
+ def _readPartition(self, i):
   if i not in [1, 2, 3, 5, 6]:
    raise Exception('Invalid partition')
   return archive.readFat(self._readFile('nflasha%d' % i))
@@ -39,11 +44,10 @@ class FirmwareUpdate(FirmwareDump):
  def _readUpdateTar(self, name):
   p = archive.Archive()
   for fn in glob.iglob(os.path.join(self._updateDir, name)):
-   with open(fn, 'rb') as f:
-    p.writeAll(archive.readTar(f.read()))
+   p.writeAll(archive.readTar(firmware.defaultStore.read(fn)))
   return p
 
- def getPartition(self, i):
+ def _readPartition(self, i):
   p = archive.Archive()
 
   if i == 2:
@@ -52,7 +56,7 @@ class FirmwareUpdate(FirmwareDump):
    for f in ['Asys', 'Hsys']:
     p.write('/factory/%s.bin' % f, self._readFile('%s.bin' % f))
     p.write('/factory/%s2.bak' % f, self._readFile('%s.bin' % f))
-   p.patch('/factory/Areg.bin', lambda d: p.read('/factory/Asys.bin')[:1] + d[1:])
+   p.patch('/factory/Areg.bin', [patch.Write(0, p.read('/factory/Asys.bin')[:1])])
 
   elif i == 3:
    p.writeAll(self._readUpdateTar('linuxset[1-9].tar'), '/boot')
@@ -66,7 +70,7 @@ class FirmwareUpdate(FirmwareDump):
     p.writeAll(self._readUpdateTar(f))
 
   else:
-   p = super().getPartition(i)
+   p = super()._readPartition(i)
 
   return p
 
@@ -81,24 +85,32 @@ class TestCXD4108(TestCase):
  def prepareBootPartition(self):
   return self.firmware.getBootPartition()
 
+ @build.step
+ @cache.cached
  def prepareUpdaterKernel(self, unpackZimage=False):
   kernel = self.firmware.getPartition(1).read('/boot/vmlinux')
   if unpackZimage:
    kernel = zimage.unpackZimage(kernel)
   return kernel
 
+ @build.step
+ @cache.cached
  def prepareUpdaterInitrd(self, shellOnly=False):
   initrd = archive.readCramfs(self.firmware.getPartition(1).read('/boot/initrd.img'))
   if shellOnly:
-   initrd.write('/sbin/init', b'#!/bin/sh\nmount -t proc proc /proc\nwhile true; do sh; done\n')
+   initrd.write('/sbin/init', b'#!/bin/sh\nmount -t proc proc /proc\n' + qemu.agentScript().encode() + b'while true; do sh; done\n')
   return archive.writeCramfs(initrd)
 
+ @build.step
+ @cache.cached
  def prepareMainKernel(self, patchConsoleEnable=False):
   kernel = self.firmware.getPartition(3).read('/boot/vmlinux')
   if patchConsoleEnable:
    kernel = kernel_patch.patchConsoleEnable(kernel)
   return kernel
 
+ @build.step
+ @cache.cached
  def prepareFlash1(self, kernel=None, initrd=None):
   nflasha1 = self.firmware.getPartition(1)
   if kernel:
@@ -107,6 +119,8 @@ class TestCXD4108(TestCase):
    nflasha1.write('/boot/initrd.img', initrd)
   return archive.writeFat(nflasha1, 0x200000)
 
+ @build.step
+ @cache.cached
  def prepareFlash2(self, readSettings=False, updaterMode=False, patchTouchscreenEnable=False, patchLensCoverEnable=False, ntscOnly=False):
   nflasha2 = archive.Archive()
   if readSettings:
@@ -117,13 +131,15 @@ class TestCXD4108(TestCase):
   if updaterMode:
    nflasha2.write('/updater/mode', b'')
   if patchTouchscreenEnable:
-   nflasha2.patch('/factory/Asys.bin', lambda d: d[:0x2a5] + b'\x01' + d[0x2a6:])
+   nflasha2.patch('/factory/Asys.bin', [patch.Write(0x2a5, b'\x01')])
   if patchLensCoverEnable:
-   nflasha2.patch('/factory/Asys.bin', lambda d: d[:0x2a6] + b'\x01' + d[0x2a7:])
+   nflasha2.patch('/factory/Asys.bin', [patch.Write(0x2a6, b'\x01')])
   if ntscOnly:
-   nflasha2.patch('/factory/Hreg.bin', lambda d: d[:0x400] + b'\x02' + d[0x401:])
+   nflasha2.patch('/factory/Hreg.bin', [patch.Write(0x400, b'\x02')])
   return archive.writeFat(nflasha2, 0x180000)
 
+ @build.step
+ @cache.cached
  def prepareFlash3(self, kernel=None, rootfs=None):
   nflasha3 = self.firmware.getPartition(3)
   if kernel:
@@ -132,18 +148,26 @@ class TestCXD4108(TestCase):
    nflasha3.write('/boot/rootfs.img', rootfs)
   return archive.writeFat(nflasha3, 0x400000)
 
+ @build.step
+ @cache.cached
  def prepareFlash5(self):
   nflasha5 = self.firmware.getPartition(5)
   return archive.writeFat(nflasha5, 0x380000)
 
+ @build.step
+ @cache.cached
  def prepareFlash6(self):
   nflasha6 = self.firmware.getPartition(6)
   return archive.writeFat(nflasha6, 0x1000000)
 
+ @build.step
+ @cache.cached
  def prepareFlash11(self):
   nflasha11 = archive.Archive()
   return archive.writeMbr([archive.writeFat(nflasha11, 0xfffe00)])
 
+ @build.step
+ @cache.cachedFile
  def prepareNand(self, boot=b'', partitions=[]):
   return onenand.writeNand(boot, archive.writeFlash(partitions), self.NAND_SIZE, 0x100000)
 
@@ -182,14 +206,21 @@ class TestDscW90(TestCXD4108):
   return args
 
  def checkShell(self, func, checkCpuinfo=True, checkVersion=True):
+  cmds = [cmd for cmd, check in [('cat /proc/cpuinfo', checkCpuinfo), ('cat /proc/version', checkVersion)] if check]
+  outputs = {}
+  for cmd, (output, rc) in zip(cmds, func(cmds)):
+   if rc:
+    raise Exception('%s failed with exit code %d' % (cmd, rc))
+   outputs[cmd] = output
+
   if checkCpuinfo:
-   cpuinfo = func('cat /proc/cpuinfo')
+   cpuinfo = outputs['cat /proc/cpuinfo']
    self.log.info('/proc/cpuinfo:\n%s', textwrap.indent(cpuinfo, '  '))
    if 'Hardware\t: ARM-CXD4108\n' not in cpuinfo:
     raise Exception('Invalid cpuinfo')
 
   if checkVersion:
-   version = func('cat /proc/version')
+   version = outputs['cat /proc/version']
    self.log.info('/proc/version:\n%s', textwrap.indent(version, '  '))
    if not version.startswith('Linux version 2.6'):
     raise Exception('Invalid version')
@@ -202,10 +233,12 @@ class TestDscW90(TestCXD4108):
   }
   args = self.prepareQemuArgs(kernel='vmlinux.bin', initrd='initrd.img')
 
-  with qemu.QemuRunner(self.MACHINE, args, files) as q:
-   q.expectLine(lambda l: l.startswith('BusyBox'))
+  def boot(q):
+   q.expectLine(lambda l: l.startswith('BusyBox'), timeout=self.BOOT_TIMEOUT)
    time.sleep(.5)
-   self.checkShell(q.execShellCommand)
+
+  with qemu.QemuRunner(self.MACHINE, args, files, numSerial=2, agentSerial=1, checkpoint='shell', boot=boot) as q:
+   self.checkShell(q.execShellCommands)
 
 
  def testLoader2Updater(self):
@@ -223,10 +256,12 @@ class TestDscW90(TestCXD4108):
   }
   args = self.prepareQemuArgs(nand='nand.dat')
 
-  with qemu.QemuRunner(self.MACHINE, args, files) as q:
-   q.expectLine(lambda l: l.startswith('BusyBox'))
+  def boot(q):
+   q.expectLine(lambda l: l.startswith('BusyBox'), timeout=self.BOOT_TIMEOUT)
    time.sleep(.5)
-   self.checkShell(q.execShellCommand)
+
+  with qemu.QemuRunner(self.MACHINE, args, files, checkpoint='shell', boot=boot) as q:
+   self.checkShell(q.execShellCommands)
 
 
  def testLoader1Updater(self):
@@ -245,10 +280,12 @@ class TestDscW90(TestCXD4108):
   }
   args = self.prepareQemuArgs(bootRom='rom.dat', nand='nand.dat')
 
-  with qemu.QemuRunner(self.MACHINE, args, files) as q:
-   q.expectLine(lambda l: l.startswith('BusyBox'))
+  def boot(q):
+   q.expectLine(lambda l: l.startswith('BusyBox'), timeout=self.BOOT_TIMEOUT)
    time.sleep(.5)
-   self.checkShell(q.execShellCommand)
+
+  with qemu.QemuRunner(self.MACHINE, args, files, checkpoint='shell', boot=boot) as q:
+   self.checkShell(q.execShellCommands)
 
 
 class TestDscT100(TestCXD4108):
@@ -294,15 +331,17 @@ class TestDscT100(TestCXD4108):
   }
   args = self.prepareQemuArgs(bootRom='rom.dat', nand='nand.dat')
 
-  with qemu.QemuRunner(self.MACHINE, args, files, timeout=20) as q:
+  with qemu.QemuRunner(self.MACHINE, args, files, timeout=20, numSerial=2, eventSerial=1) as q:
    def waitScreen():
-    q.execShellCommand('cat /dev/blog_fsk > /dev/null; until egrep \'^.{8}038504002b20627265774642446973706f73654269746d617000\' /dev/blog_fsk > /dev/null; do usleep 200000; done')
+    q.startEventStream('/dev/ttyAM1')
+    try:
+     q.waitForEvent('^.{8}038504002b20627265774642446973706f73654269746d617000')
+    finally:
+     q.stopEventStream()
     time.sleep(1)
 
    def pressKey(key):
-    q.sendKey(key, True)
-    q.sendKey(key, False)
-    time.sleep(.5)
+    q.sendInput(qemu.InputSequence().press(key, hold=.05).pause(.5))
 
    def checkScreen(fn, retries=0):
     for i in range(retries + 1):
@@ -314,7 +353,7 @@ class TestDscT100(TestCXD4108):
     else:
      raise Exception('%s is different' % fn)
 
-   q.expectLine(lambda l: l.startswith('BusyBox'))
+   q.expectLine(lambda l: l.startswith('BusyBox'), timeout=self.BOOT_TIMEOUT)
    waitScreen()
    checkScreen('clock.png')
 
@@ -400,21 +439,20 @@ class TestDscG3(TestCXD4108):
   }
   args = self.prepareQemuArgs(bootRom='rom.dat', nand='nand.dat', mmc='mmc.dat')
 
-  with qemu.QemuRunner(self.MACHINE, args, files, timeout=20) as q:
+  with qemu.QemuRunner(self.MACHINE, args, files, timeout=20, numSerial=2, eventSerial=1) as q:
    def waitScreen():
-    q.execShellCommand('cat /dev/blog_fsk > /dev/null; until egrep \'^.{16}0485040000000003\' /dev/blog_fsk > /dev/null; do usleep 200000; done')
+    q.startEventStream('/dev/ttyAM1')
+    try:
+     q.waitForEvent('^.{16}0485040000000003')
+    finally:
+     q.stopEventStream()
     time.sleep(1)
 
    def pressKey(key):
-    q.sendKey(key, True)
-    q.sendKey(key, False)
-    time.sleep(.5)
+    q.sendInput(qemu.InputSequence().press(key, hold=.05).pause(.5))
 
    def click(x, y):
-    q.sendMousePos(x, y)
-    q.sendMouseButton(True)
-    q.sendMouseButton(False)
-    time.sleep(1.5)
+    q.sendInput(qemu.InputSequence().click(x, y, hold=.05).pause(1.5))
 
    def checkScreen(fn, retries=0):
     for i in range(retries + 1):
@@ -426,7 +464,7 @@ class TestDscG3(TestCXD4108):
     else:
      raise Exception('%s is different' % fn)
 
-   q.expectLine(lambda l: l.startswith('BusyBox'))
+   q.expectLine(lambda l: l.startswith('BusyBox'), timeout=self.BOOT_TIMEOUT)
    waitScreen()
    checkScreen('clock1.png')
 
@@ -3,7 +3,7 @@ import textwrap
 import time
 
 from . import TestCase
-from runner import archive, kernel_patch, onenand, qemu, usb, zimage
+from runner import archive, build, cache, firmware, kernel_patch, onenand, patch, qemu, usb, zimage
 
 class TestCXD4115(TestCase):
  MACHINE = 'cxd4115'
@@ -13,8 +13,7 @@ class TestCXD4115(TestCase):
  FIRMWARE_DIR = 'firmware/NEX-3'
 
  def readFirmwareFile(self, name):
-  with open(os.path.join(self.FIRMWARE_DIR, name), 'rb') as f:
-   return f.read()
+  return firmware.defaultStore.read(os.path.join(self.FIRMWARE_DIR, name))
 
  def prepareBootRom(self):
   return self.readFirmwareFile('bootrom')
@@ -22,23 +21,29 @@ class TestCXD4115(TestCase):
  def prepareBootPartition(self):
   return self.readFirmwareFile('boot')
 
+ @build.step
+ @cache.cached
  def prepareUpdaterKernel(self, patchConsoleEnable=False):
   kernel = archive.readFat(self.readFirmwareFile('nflasha1')).read('/boot/vmlinux')
   if patchConsoleEnable:
    kernel = zimage.patchZimage(kernel, kernel_patch.patchConsoleEnable)
   return kernel
 
+ @build.step
+ @cache.cached
  def prepareUpdaterInitrd(self, shellOnly=False, patchUpdaterLogLevel=False, patchCasCmd=False):
   initrd = archive.readCramfs(archive.readFat(self.readFirmwareFile('nflasha1')).read('/boot/initrd.img'))
   if shellOnly:
-   initrd.write('/sbin/init', b'#!/bin/sh\nmount -t proc proc /proc\nwhile true; do sh; done\n')
+   initrd.write('/sbin/init', b'#!/bin/sh\nmount -t proc proc /proc\n' + qemu.agentScript().encode() + b'while true; do sh; done\n')
   else:
    if patchUpdaterLogLevel:
-    initrd.patch('/root/UdtrMain.sh', lambda d: d.replace(b'#!/bin/sh\n', b'#!/bin/sh\ndebugio 5\n'))
+    initrd.patch('/root/UdtrMain.sh', [patch.Replace(b'#!/bin/sh\n', b'#!/bin/sh\ndebugio 5\n', 1)])
    if patchCasCmd:
-    initrd.patch('/root/UdtrMain.sh', lambda d: d.replace(b'uc_cascmd -m ca -c continu', b'true'))
+    initrd.patch('/root/UdtrMain.sh', [patch.Replace(b'uc_cascmd -m ca -c continu', b'true')])
   return archive.writeCramfs(initrd)
 
+ @build.step
+ @cache.cached
  def prepareFlash1(self, kernel=None, initrd=None):
   nflasha1 = archive.readFat(self.readFirmwareFile('nflasha1'))
   if kernel:
@@ -47,6 +52,8 @@ class TestCXD4115(TestCase):
    nflasha1.write('/boot/initrd.img', initrd)
   return archive.writeFat(nflasha1, 0x400000)
 
+ @build.step
+ @cache.cached
  def prepareFlash2(self, updaterMode=False):
   nflasha2 = archive.Archive()
   nflasha2.write('/updater/dat4', b'\x00\x01')
@@ -54,6 +61,8 @@ class TestCXD4115(TestCase):
    nflasha2.write('/updater/mode', b'')
   return archive.writeFat(nflasha2, 0x400000)
 
+ @build.step
+ @cache.cachedFile
  def prepareNand(self, boot=b'', partitions=[]):
   return onenand.writeNand(boot, archive.writeFlash(partitions), self.NAND_SIZE)
 
@@ -74,14 +83,21 @@ class TestCXD4115(TestCase):
   return args
 
  def checkShell(self, func, checkCpuinfo=True, checkVersion=True):
+  cmds = [cmd for cmd, check in [('cat /proc/cpuinfo', checkCpuinfo), ('cat /proc/version', checkVersion)] if check]
+  outputs = {}
+  for cmd, (output, rc) in zip(cmds, func(cmds)):
+   if rc:
+    raise Exception('%s failed with exit code %d' % (cmd, rc))
+   outputs[cmd] = output
+
   if checkCpuinfo:
-   cpuinfo = func('cat /proc/cpuinfo')
+   cpuinfo = outputs['cat /proc/cpuinfo']
    self.log.info('/proc/cpuinfo:\n%s', textwrap.indent(cpuinfo, '  '))
    if 'Hardware\t: ARM-CXD4115\n' not in cpuinfo:
     raise Exception('Invalid cpuinfo')
 
   if checkVersion:
-   version = func('cat /proc/version')
+   version = outputs['cat /proc/version']
    self.log.info('/proc/version:\n%s', textwrap.indent(version, '  '))
    if not version.startswith('Linux version 2.6'):
     raise Exception('Invalid version')
@@ -94,10 +110,12 @@ class TestCXD4115(TestCase):
   }
   args = self.prepareQemuArgs(kernel='vmlinux.bin', initrd='initrd.img')
 
-  with qemu.QemuRunner(self.MACHINE, args, files) as q:
-   q.expectLine(lambda l: l.startswith('BusyBox'))
+  def boot(q):
+   q.expectLine(lambda l: l.startswith('BusyBox'), timeout=self.BOOT_TIMEOUT)
    time.sleep(.5)
-   self.checkShell(q.execShellCommand)
+
+  with qemu.QemuRunner(self.MACHINE, args, files, numSerial=2, agentSerial=1, checkpoint='shell', boot=boot) as q:
+   self.checkShell(q.execShellCommands)
 
 
  def testLoader2Updater(self):
@@ -115,10 +133,12 @@ class TestCXD4115(TestCase):
   }
   args = self.prepareQemuArgs(nand='nand.dat')
 
-  with qemu.QemuRunner(self.MACHINE, args, files) as q:
-   q.expectLine(lambda l: l.startswith('BusyBox'))
+  def boot(q):
+   q.expectLine(lambda l: l.startswith('BusyBox'), timeout=self.BOOT_TIMEOUT)
    time.sleep(.5)
-   self.checkShell(q.execShellCommand)
+
+  with qemu.QemuRunner(self.MACHINE, args, files, numSerial=2, agentSerial=1, checkpoint='shell', boot=boot) as q:
+   self.checkShell(q.execShellCommands)
 
 
  def testUpdaterUsb(self):
@@ -138,11 +158,11 @@ class TestCXD4115(TestCase):
   args = self.prepareQemuArgs(bootRom='rom.dat', nand='nand.dat')
 
   with qemu.QemuRunner(self.MACHINE, args, files) as q:
-   q.expectLine(lambda l: l.startswith('BusyBox'))
-   q.expectLine(lambda l: '"DONE onEvent(COMP_START or COMP_STOP)"' in l)
+   q.expectLine(lambda l: l.startswith('BusyBox'), timeout=self.BOOT_TIMEOUT)
+   q.expectLine(lambda l: '"DONE onEvent(COMP_START or COMP_STOP)"' in l, timeout=self.BOOT_TIMEOUT)
 
    with usb.PmcaRunner('updatershell', ['-d', 'qemu', '-m', self.MODEL]) as pmca:
     pmca.expectLine(lambda l: l == 'Welcome to USB debug shell.')
-    self.checkShell(lambda c: pmca.execUpdaterShellCommand('shell %s' % c))
+    self.checkShell(lambda cmds: [(pmca.execUpdaterShellCommand('shell %s' % c), None) for c in cmds])
     pmca.writeLine('exit')
     pmca.expectLine(lambda l: l == 'Done')
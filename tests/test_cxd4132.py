@@ -3,7 +3,7 @@ import textwrap
 import time
 
 from . import TestCase
-from runner import archive, onenand, qemu, usb, zimage
+from runner import archive, build, cache, firmware, onenand, patch, qemu, usb, zimage
 
 class TestCXD4132(TestCase):
  MACHINE = 'cxd4132'
@@ -13,8 +13,7 @@ class TestCXD4132(TestCase):
  FIRMWARE_DIR = 'firmware/DSC-QX10'
 
  def readFirmwareFile(self, name):
-  with open(os.path.join(self.FIRMWARE_DIR, name), 'rb') as f:
-   return f.read()
+  return firmware.defaultStore.read(os.path.join(self.FIRMWARE_DIR, name))
 
  def prepareBootRom(self):
   return self.readFirmwareFile('bootrom')
@@ -22,21 +21,27 @@ class TestCXD4132(TestCase):
  def prepareBootPartition(self):
   return self.readFirmwareFile('boot')
 
+ @build.step
+ @cache.cached
  def prepareUpdaterKernel(self, patchConsoleEnable=False):
   kernel = archive.readFat(self.readFirmwareFile('nflasha1')).read('/boot/vmlinux')
   if patchConsoleEnable:
-   kernel = zimage.patchZimage(kernel, lambda k: k.replace(b'amba2.console=0', b'amba2.console=1'))
+   kernel = zimage.patchZimage(kernel, [patch.Replace(b'amba2.console=0', b'amba2.console=1')])
   return kernel
 
+ @build.step
+ @cache.cached
  def prepareUpdaterInitrd(self, shellOnly=False, patchTee=False):
   initrd = archive.readCramfs(archive.readFat(self.readFirmwareFile('nflasha1')).read('/boot/initrd.img'))
   if shellOnly:
-   initrd.write('/sbin/init', b'#!/bin/sh\nmount -t proc proc /proc\nwhile true; do sh; done\n')
+   initrd.write('/sbin/init', b'#!/bin/sh\nmount -t proc proc /proc\n' + qemu.agentScript().encode() + b'while true; do sh; done\n')
   else:
    if patchTee:
-    initrd.patch('/sbin/init', lambda d: d.replace(b' | tee -a $OUTPUT_LOG', b''))
+    initrd.patch('/sbin/init', [patch.Replace(b' | tee -a $OUTPUT_LOG', b'')])
   return archive.writeCramfs(initrd)
 
+ @build.step
+ @cache.cached
  def prepareFlash1(self, kernel=None, initrd=None):
   nflasha1 = archive.readFat(self.readFirmwareFile('nflasha1'))
   if kernel:
@@ -45,6 +50,8 @@ class TestCXD4132(TestCase):
    nflasha1.write('/boot/initrd.img', initrd)
   return archive.writeFat(nflasha1, 0x400000)
 
+ @build.step
+ @cache.cached
  def prepareFlash2(self, updaterMode=False, patchBackupWriteComp=False):
   initrd = archive.readCramfs(archive.readFat(self.readFirmwareFile('nflasha1')).read('/boot/initrd.img'))
   nflasha2 = archive.Archive()
@@ -55,9 +62,11 @@ class TestCXD4132(TestCase):
   if updaterMode:
    nflasha2.write('/updater/mode', b'')
   if patchBackupWriteComp:
-   nflasha2.patch('/Backup.bin', lambda d: d[:8] + b'\x01\0\0\0' + d[12:])
+   nflasha2.patch('/Backup.bin', [patch.Write(8, b'\x01\0\0\0')])
   return archive.writeFat(nflasha2, 0x400000)
 
+ @build.step
+ @cache.cachedFile
  def prepareNand(self, boot=b'', partitions=[]):
   return onenand.writeNand(boot, archive.writeFlash(partitions), self.NAND_SIZE)
 
@@ -81,14 +90,21 @@ class TestCXD4132(TestCase):
   return args
 
  def checkShell(self, func, checkCpuinfo=True, checkVersion=True):
+  cmds = [cmd for cmd, check in [('cat /proc/cpuinfo', checkCpuinfo), ('cat /proc/version', checkVersion)] if check]
+  outputs = {}
+  for cmd, (output, rc) in zip(cmds, func(cmds)):
+   if rc:
+    raise Exception('%s failed with exit code %d' % (cmd, rc))
+   outputs[cmd] = output
+
   if checkCpuinfo:
-   cpuinfo = func('cat /proc/cpuinfo')
+   cpuinfo = outputs['cat /proc/cpuinfo']
    self.log.info('/proc/cpuinfo:\n%s', textwrap.indent(cpuinfo, '  '))
    if 'Hardware\t: ARM-CXD4132\n' not in cpuinfo:
     raise Exception('Invalid cpuinfo')
 
   if checkVersion:
-   version = func('cat /proc/version')
+   version = outputs['cat /proc/version']
    self.log.info('/proc/version:\n%s', textwrap.indent(version, '  '))
    if not version.startswith('Linux version 2.6'):
     raise Exception('Invalid version')
@@ -101,10 +117,12 @@ class TestCXD4132(TestCase):
   }
   args = self.prepareQemuArgs(kernel='vmlinux.bin', initrd='initrd.img')
 
-  with qemu.QemuRunner(self.MACHINE, args, files) as q:
-   q.expectLine(lambda l: l.startswith('BusyBox'))
+  def boot(q):
+   q.expectLine(lambda l: l.startswith('BusyBox'), timeout=self.BOOT_TIMEOUT)
    time.sleep(.5)
-   self.checkShell(q.execShellCommand)
+
+  with qemu.QemuRunner(self.MACHINE, args, files, numSerial=2, agentSerial=1, checkpoint='shell', boot=boot) as q:
+   self.checkShell(q.execShellCommands)
 
 
  def testLoader2Updater(self):
@@ -122,12 +140,27 @@ class TestCXD4132(TestCase):
   }
   args = self.prepareQemuArgs(nand='nand.dat', patchLoader2LogLevel=True)
 
-  with qemu.QemuRunner(self.MACHINE, args, files) as q:
-   q.expectLine(lambda l: l.startswith('diadem opal Loader2'))
-   q.expectLine(lambda l: l.startswith('LDR: Jump to kernel'))
-   q.expectLine(lambda l: l.startswith('BusyBox'))
+  def boot(q):
+   q.expectLine(lambda l: l.startswith('diadem opal Loader2'), timeout=self.BOOT_TIMEOUT)
+   q.expectLine(lambda l: l.startswith('LDR: Jump to kernel'), timeout=self.BOOT_TIMEOUT)
+   q.expectLine(lambda l: l.startswith('BusyBox'), timeout=self.BOOT_TIMEOUT)
    time.sleep(.5)
-   self.checkShell(q.execShellCommand)
+
+  with qemu.QemuRunner(self.MACHINE, args, files, numSerial=2, agentSerial=1, checkpoint='shell', boot=boot, writableFiles=['nand.dat']) as q:
+   self.checkShell(q.execShellCommands)
+   [(output, rc)] = q.execShellCommands(['mount -t vfat /dev/nflasha2 /mnt && echo %s > /mnt/MARKER.TXT && umount /mnt' % self.MODEL])
+   if rc:
+    raise Exception('Cannot write to flash: %s' % output)
+
+  # Read back what the guest wrote to the flash
+  bootPartition, data = onenand.readNand(q.outputFiles['nand.dat'])
+  partitions = archive.readFlash(data)
+  if len(partitions) < 2:
+   raise Exception('Cannot find flash partitions')
+  nflasha2 = archive.readFilesystem(partitions[1])
+  marker = next((fn for fn in nflasha2.files if fn.lower() == '/marker.txt'), None)
+  if not marker or nflasha2.read(marker) != self.MODEL.encode() + b'\n':
+   raise Exception('Invalid marker in flash partition 2')
 
 
  def testUpdaterUsb(self):
@@ -147,16 +180,16 @@ class TestCXD4132(TestCase):
   args = self.prepareQemuArgs(bootRom='rom.dat', nand='nand.dat', patchLoader2LogLevel=True)
 
   with qemu.QemuRunner(self.MACHINE, args, files) as q:
-   q.expectLine(lambda l: l.startswith('opal Loader1'))
-   q.expectLine(lambda l: l.startswith('diadem opal Loader2'))
-   q.expectLine(lambda l: l.startswith('LDR: Jump to kernel'))
-   q.expectLine(lambda l: l.startswith('BusyBox'))
-   q.expectLine(lambda l: l.endswith('"DONE onEvent(COMP_START or COMP_STOP)"'))
+   q.expectLine(lambda l: l.startswith('opal Loader1'), timeout=self.BOOT_TIMEOUT)
+   q.expectLine(lambda l: l.startswith('diadem opal Loader2'), timeout=self.BOOT_TIMEOUT)
+   q.expectLine(lambda l: l.startswith('LDR: Jump to kernel'), timeout=self.BOOT_TIMEOUT)
+   q.expectLine(lambda l: l.startswith('BusyBox'), timeout=self.BOOT_TIMEOUT)
+   q.expectLine(lambda l: l.endswith('"DONE onEvent(COMP_START or COMP_STOP)"'), timeout=self.BOOT_TIMEOUT)
 
    with usb.PmcaRunner('updatershell', ['-d', 'qemu', '-m', self.MODEL]) as pmca:
     pmca.expectLine(lambda l: l == 'Welcome to USB debug shell.')
-    self.checkShell(lambda c: pmca.execUpdaterShellCommand('shell %s' % c))
+    self.checkShell(lambda cmds: [(pmca.execUpdaterShellCommand('shell %s' % c), None) for c in cmds])
     pmca.writeLine('exit')
     pmca.expectLine(lambda l: l == '>Done')
 
-   q.expectLine(lambda l: l == 'updaterufp OK')
+   q.expectLine(lambda l: l == 'updaterufp OK', timeout=self.BOOT_TIMEOUT)
@@ -3,7 +3,7 @@ import textwrap
 import time
 
 from . import TestCase
-from runner import archive, nand, qemu, usb, zimage
+from runner import archive, build, cache, firmware, image, nand, patch, qemu, usb, zimage
 
 class TestCXD90014(TestCase):
  MACHINE = 'cxd90014'
@@ -13,8 +13,7 @@ class TestCXD90014(TestCase):
  FIRMWARE_DIR = 'firmware/DSC-RX100M5'
 
  def readFirmwareFile(self, name):
-  with open(os.path.join(self.FIRMWARE_DIR, name), 'rb') as f:
-   return f.read()
+  return firmware.defaultStore.read(os.path.join(self.FIRMWARE_DIR, name))
 
  def prepareBootRom(self):
   return self.readFirmwareFile('bootrom')
@@ -23,25 +22,31 @@ class TestCXD90014(TestCase):
   return nand.writeNandBlock0(self.NAND_SIZE) + self.readFirmwareFile('boot1')
 
  def prepareNormalBootPartition(self):
-  return 3 * 0x40 * 0x1000 * b'\xff' + self.readFirmwareFile('boot5')
+  return image.Image([image.Fill(3 * 0x40 * 0x1000, b'\xff'), self.readFirmwareFile('boot5')])
 
+ @build.step
+ @cache.cached
  def prepareUpdaterKernel(self, unpackZimage=False, patchConsoleEnable=False):
   kernel = archive.readFat(self.readFirmwareFile('nflasha1')).read('/boot/vmlinux.bin')
   if unpackZimage:
    kernel = zimage.unpackZimage(kernel)
    if patchConsoleEnable:
-    kernel = kernel.replace(b'amba2.console=0', b'amba2.console=1')
+    kernel = patch.apply(kernel, [patch.Replace(b'amba2.console=0', b'amba2.console=1')])
   else:
    if patchConsoleEnable:
-    kernel = zimage.patchZimage(kernel, lambda k: k.replace(b'amba2.console=0', b'amba2.console=1'))
+    kernel = zimage.patchZimage(kernel, [patch.Replace(b'amba2.console=0', b'amba2.console=1')])
   return kernel
 
+ @build.step
+ @cache.cached
  def prepareUpdaterInitrd(self, shellOnly=False):
   initrd = archive.readCramfs(archive.readFat(self.readFirmwareFile('nflasha1')).read('/boot/initrd.img'))
   if shellOnly:
-   initrd.write('/sbin/init', b'#!/bin/sh\nmount -t proc proc /proc\nwhile true; do sh; done\n')
+   initrd.write('/sbin/init', b'#!/bin/sh\nmount -t proc proc /proc\n' + qemu.agentScript().encode() + b'while true; do sh; done\n')
   return archive.writeCramfs(initrd)
 
+ @build.step
+ @cache.cached
  def prepareFlash1(self, kernel=None, initrd=None):
   nflasha1 = archive.readFat(self.readFirmwareFile('nflasha1'))
   if kernel:
@@ -50,6 +55,8 @@ class TestCXD90014(TestCase):
    nflasha1.write('/boot/initrd.img', initrd)
   return archive.writeFat(nflasha1, 0x800000)
 
+ @build.step
+ @cache.cached
  def prepareFlash2(self, updaterMode=False, patchBackupWriteComp=False):
   nflasha2 = archive.Archive()
   nflasha2.write('/Backup.bin', self.readFirmwareFile('Backup.bin'))
@@ -59,9 +66,11 @@ class TestCXD90014(TestCase):
   if updaterMode:
    nflasha2.write('/updater/mode', b'')
   if patchBackupWriteComp:
-   nflasha2.patch('/Backup.bin', lambda d: d[:8] + b'\x01\0\0\0' + d[12:])
+   nflasha2.patch('/Backup.bin', [patch.Write(8, b'\x01\0\0\0')])
   return archive.writeFat(nflasha2, 0x400000)
 
+ @build.step
+ @cache.cachedFile
  def prepareNand(self, safeBoot=b'', normalBoot=b'', partitions=[]):
   return nand.writeNand(safeBoot, normalBoot, archive.writeFlash(partitions), self.NAND_SIZE)
 
@@ -85,14 +94,21 @@ class TestCXD90014(TestCase):
   return args
 
  def checkShell(self, func, checkCpuinfo=True, checkVersion=True):
+  cmds = [cmd for cmd, check in [('cat /proc/cpuinfo', checkCpuinfo), ('cat /proc/version', checkVersion)] if check]
+  outputs = {}
+  for cmd, (output, rc) in zip(cmds, func(cmds)):
+   if rc:
+    raise Exception('%s failed with exit code %d' % (cmd, rc))
+   outputs[cmd] = output
+
   if checkCpuinfo:
-   cpuinfo = func('cat /proc/cpuinfo')
+   cpuinfo = outputs['cat /proc/cpuinfo']
    self.log.info('/proc/cpuinfo:\n%s', textwrap.indent(cpuinfo, '  '))
    if 'Hardware\t: ARM-CXD90014\n' not in cpuinfo:
     raise Exception('Invalid cpuinfo')
 
   if checkVersion:
-   version = func('cat /proc/version')
+   version = outputs['cat /proc/version']
    self.log.info('/proc/version:\n%s', textwrap.indent(version, '  '))
    if not version.startswith('Linux version 3.0'):
     raise Exception('Invalid version')
@@ -105,10 +121,12 @@ class TestCXD90014(TestCase):
   }
   args = self.prepareQemuArgs(kernel='vmlinux.bin', initrd='initrd.img')
 
-  with qemu.QemuRunner(self.MACHINE, args, files) as q:
-   q.expectLine(lambda l: l.startswith('BusyBox'))
+  def boot(q):
+   q.expectLine(lambda l: l.startswith('BusyBox'), timeout=self.BOOT_TIMEOUT)
    time.sleep(.5)
-   self.checkShell(q.execShellCommand)
+
+  with qemu.QemuRunner(self.MACHINE, args, files, numSerial=2, agentSerial=1, checkpoint='shell', boot=boot) as q:
+   self.checkShell(q.execShellCommands)
 
 
  def testLoader2Updater(self):
@@ -127,13 +145,15 @@ class TestCXD90014(TestCase):
   }
   args = self.prepareQemuArgs(nand='nand.dat', patchLoader2LogLevel=True)
 
-  with qemu.QemuRunner(self.MACHINE, args, files) as q:
-   q.expectLine(lambda l: l.startswith('Loader2'))
-   q.expectLine(lambda l: l.startswith('Loader3'))
-   q.expectLine(lambda l: l.startswith('LDR:Jump to kernel'))
-   q.expectLine(lambda l: l.startswith('BusyBox'))
+  def boot(q):
+   q.expectLine(lambda l: l.startswith('Loader2'), timeout=self.BOOT_TIMEOUT)
+   q.expectLine(lambda l: l.startswith('Loader3'), timeout=self.BOOT_TIMEOUT)
+   q.expectLine(lambda l: l.startswith('LDR:Jump to kernel'), timeout=self.BOOT_TIMEOUT)
+   q.expectLine(lambda l: l.startswith('BusyBox'), timeout=self.BOOT_TIMEOUT)
    time.sleep(.5)
-   self.checkShell(q.execShellCommand)
+
+  with qemu.QemuRunner(self.MACHINE, args, files, numSerial=2, agentSerial=1, checkpoint='shell', boot=boot) as q:
+   self.checkShell(q.execShellCommands)
 
 
  def testUpdaterUsb(self):
@@ -154,17 +174,17 @@ class TestCXD90014(TestCase):
   args = self.prepareQemuArgs(bootRom='rom.dat', nand='nand.dat', patchLoader2LogLevel=True)
 
   with qemu.QemuRunner(self.MACHINE, args, files) as q:
-   q.expectLine(lambda l: l.startswith('Musashi Loader1'))
-   q.expectLine(lambda l: l.startswith('Loader2'))
-   q.expectLine(lambda l: l.startswith('Loader3'))
-   q.expectLine(lambda l: l.startswith('LDR:Jump to kernel'))
-   q.expectLine(lambda l: l.startswith('BusyBox'))
-   q.expectLine(lambda l: l.endswith('"DONE onEvent(COMP_START or COMP_STOP)"'))
+   q.expectLine(lambda l: l.startswith('Musashi Loader1'), timeout=self.BOOT_TIMEOUT)
+   q.expectLine(lambda l: l.startswith('Loader2'), timeout=self.BOOT_TIMEOUT)
+   q.expectLine(lambda l: l.startswith('Loader3'), timeout=self.BOOT_TIMEOUT)
+   q.expectLine(lambda l: l.startswith('LDR:Jump to kernel'), timeout=self.BOOT_TIMEOUT)
+   q.expectLine(lambda l: l.startswith('BusyBox'), timeout=self.BOOT_TIMEOUT)
+   q.expectLine(lambda l: l.endswith('"DONE onEvent(COMP_START or COMP_STOP)"'), timeout=self.BOOT_TIMEOUT)
 
    with usb.PmcaRunner('updatershell', ['-d', 'qemu', '-m', self.MODEL]) as pmca:
     pmca.expectLine(lambda l: l == 'Welcome to USB debug shell.')
-    self.checkShell(lambda c: pmca.execUpdaterShellCommand('shell %s' % c))
+    self.checkShell(lambda cmds: [(pmca.execUpdaterShellCommand('shell %s' % c), None) for c in cmds])
     pmca.writeLine('exit')
     pmca.expectLine(lambda l: l == '>Done')
 
-   q.expectLine(lambda l: l == 'User Update OK')
+   q.expectLine(lambda l: l == 'User Update OK', timeout=self.BOOT_TIMEOUT)
@@ -3,7 +3,7 @@ import textwrap
 import time
 
 from . import TestCase
-from runner import archive, emmc, qemu
+from runner import archive, build, cache, emmc, firmware, patch, qemu
 
 class TestCXD90045(TestCase):
  MACHINE = 'cxd90045'
@@ -13,8 +13,7 @@ class TestCXD90045(TestCase):
  FIRMWARE_DIR = 'firmware/DSC-HX99'
 
  def readFirmwareFile(self, name):
-  with open(os.path.join(self.FIRMWARE_DIR, name), 'rb') as f:
-   return f.read()
+  return firmware.defaultStore.read(os.path.join(self.FIRMWARE_DIR, name))
 
  def prepareBootRom(self):
   return self.readFirmwareFile('bootrom')
@@ -22,21 +21,27 @@ class TestCXD90045(TestCase):
  def prepareBootPartition(self, patchInitPower=False):
   boot = self.readFirmwareFile('boot')
   if patchInitPower:
-   boot = boot[:0x87c4] + b'\0\0\0\0' + boot[0x87c8:]
+   boot = patch.apply(boot, [patch.Write(0x87c4, b'\0\0\0\0')])
   return boot
 
+ @build.step
+ @cache.cached
  def prepareUpdaterKernel(self):
   return archive.readFat(self.readFirmwareFile('nflasha1')).read('/boot/vmlinux.bin')
 
+ @build.step
+ @cache.cached
  def prepareUpdaterInitrd(self, shellOnly=False, patchUpdaterMain=False):
   initrd = archive.readCramfs(archive.readFat(self.readFirmwareFile('nflasha1')).read('/boot/initrd.img'))
   if shellOnly:
-   initrd.write('/sbin/init', b'#!/bin/sh\nmount -t proc proc /proc\nwhile true; do sh; done\n')
+   initrd.write('/sbin/init', b'#!/bin/sh\nmount -t proc proc /proc\n' + qemu.agentScript().encode() + b'while true; do sh; done\n')
   else:
    if patchUpdaterMain:
     initrd.write('/usr/bin/UdtrMain.sh', b'#!/bin/sh\n')
   return archive.writeCramfs(initrd)
 
+ @build.step
+ @cache.cached
  def prepareFlash1(self, kernel=None, initrd=None, patchConsoleEnable=False):
   nflasha1 = archive.readFat(self.readFirmwareFile('nflasha1'))
   if kernel:
@@ -44,15 +49,19 @@ class TestCXD90045(TestCase):
   if initrd:
    nflasha1.write('/boot/initrd.img', initrd)
   if patchConsoleEnable:
-   nflasha1.patch('/boot/kemco.txt', lambda d: d.replace(b'amba2.console=0', b'amba2.console=1'))
+   nflasha1.patch('/boot/kemco.txt', [patch.Replace(b'amba2.console=0', b'amba2.console=1')])
   return archive.writeFat(nflasha1, 0x800000)
 
+ @build.step
+ @cache.cached
  def prepareFlash2(self, updaterMode=False):
   nflasha2 = archive.Archive()
   if updaterMode:
    nflasha2.write('/updater/mode', b'')
   return archive.writeFat(nflasha2, 0x400000)
 
+ @build.step
+ @cache.cachedFile
  def prepareEmmc(self, boot=b'', partitions=[]):
   return emmc.writeEmmc(boot, archive.writeFlash(partitions), self.EMMC_SIZE)
 
@@ -76,14 +85,21 @@ class TestCXD90045(TestCase):
   return args
 
  def checkShell(self, func, checkCpuinfo=True, checkVersion=True):
+  cmds = [cmd for cmd, check in [('cat /proc/cpuinfo', checkCpuinfo), ('cat /proc/version', checkVersion)] if check]
+  outputs = {}
+  for cmd, (output, rc) in zip(cmds, func(cmds)):
+   if rc:
+    raise Exception('%s failed with exit code %d' % (cmd, rc))
+   outputs[cmd] = output
+
   if checkCpuinfo:
-   cpuinfo = func('cat /proc/cpuinfo')
+   cpuinfo = outputs['cat /proc/cpuinfo']
    self.log.info('/proc/cpuinfo:\n%s', textwrap.indent(cpuinfo, '  '))
    if 'Hardware\t: ARM-CXD900X0\n' not in cpuinfo:
     raise Exception('Invalid cpuinfo')
 
   if checkVersion:
-   version = func('cat /proc/version')
+   version = outputs['cat /proc/version']
    self.log.info('/proc/version:\n%s', textwrap.indent(version, '  '))
    if not version.startswith('Linux version 3.0'):
     raise Exception('Invalid version')
@@ -96,10 +112,12 @@ class TestCXD90045(TestCase):
   }
   args = self.prepareQemuArgs(kernel='vmlinux.bin', initrd='initrd.img')
 
-  with qemu.QemuRunner(self.MACHINE, args, files) as q:
-   q.expectLine(lambda l: l.startswith('BusyBox'))
+  def boot(q):
+   q.expectLine(lambda l: l.startswith('BusyBox'), timeout=self.BOOT_TIMEOUT)
    time.sleep(.5)
-   self.checkShell(q.execShellCommand)
+
+  with qemu.QemuRunner(self.MACHINE, args, files, numSerial=2, agentSerial=1, checkpoint='shell', boot=boot) as q:
+   self.checkShell(q.execShellCommands)
 
 
  def testLoader2Updater(self):
@@ -118,12 +136,14 @@ class TestCXD90045(TestCase):
   }
   args = self.prepareQemuArgs(emmc='emmc.dat', patchLoader2LogLevel=True)
 
-  with qemu.QemuRunner(self.MACHINE, args, files) as q:
-   q.expectLine(lambda l: l.startswith('Loader2'))
-   q.expectLine(lambda l: l.startswith('LDR:Jump to kernel'))
-   q.expectLine(lambda l: l.startswith('BusyBox'))
+  def boot(q):
+   q.expectLine(lambda l: l.startswith('Loader2'), timeout=self.BOOT_TIMEOUT)
+   q.expectLine(lambda l: l.startswith('LDR:Jump to kernel'), timeout=self.BOOT_TIMEOUT)
+   q.expectLine(lambda l: l.startswith('BusyBox'), timeout=self.BOOT_TIMEOUT)
    time.sleep(.5)
-   self.checkShell(q.execShellCommand)
+
+  with qemu.QemuRunner(self.MACHINE, args, files, checkpoint='shell', boot=boot) as q:
+   self.checkShell(q.execShellCommands)
 
 
  def testLoader1(self):
@@ -143,10 +163,12 @@ class TestCXD90045(TestCase):
   }
   args = self.prepareQemuArgs(bootRom='rom.dat', emmc='emmc.dat', patchLoader2LogLevel=True)
 
-  with qemu.QemuRunner(self.MACHINE, args, files) as q:
-   q.expectLine(lambda l: l.startswith('Astra Loader1'))
-   q.expectLine(lambda l: l.startswith('Loader2'))
-   q.expectLine(lambda l: l.startswith('LDR:Jump to kernel'))
-   q.expectLine(lambda l: l.startswith('BusyBox'))
+  def boot(q):
+   q.expectLine(lambda l: l.startswith('Astra Loader1'), timeout=self.BOOT_TIMEOUT)
+   q.expectLine(lambda l: l.startswith('Loader2'), timeout=self.BOOT_TIMEOUT)
+   q.expectLine(lambda l: l.startswith('LDR:Jump to kernel'), timeout=self.BOOT_TIMEOUT)
+   q.expectLine(lambda l: l.startswith('BusyBox'), timeout=self.BOOT_TIMEOUT)
    time.sleep(.5)
-   self.checkShell(q.execShellCommand)
+
+  with qemu.QemuRunner(self.MACHINE, args, files, checkpoint='shell', boot=boot) as q:
+   self.checkShell(q.execShellCommands)
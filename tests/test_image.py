@@ -0,0 +1,20 @@
+from . import TestCase
+from runner import image
+
+class TestImage(TestCase):
+ def testFromBytes(self):
+  data = b'abc' + b'\xff' * 2 * image.CHUNK_SIZE
+  img = image.fromBytes(data)
+  self.assertEqual(len(img), len(data))
+  self.assertIsInstance(img.segments[-1], image.Fill)
+  self.assertEqual(img.getvalue(), data)
+  self.assertEqual(img.read(1, 5), data[1:5])
+
+ def testRegions(self):
+  part = image.Image([b'abcd'])
+  part.regions['a'] = (1, 2, 'k')
+  img = image.Image([b'xy', part])
+  img.fill(4)
+  self.assertEqual(img.regions, {'a': (3, 2, 'k')})
+  self.assertEqual(img.getvalue(), b'xyabcd\xff\xff\xff\xff')
+  self.assertEqual(list(img.slices(4, 8)), [b'cd', image.Fill(2, b'\xff')])
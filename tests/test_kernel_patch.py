@@ -0,0 +1,39 @@
+import struct
+import unittest.mock
+
+from . import TestCase
+from runner import cache, kernel_patch
+
+class TestKernelPatch(TestCase):
+ def testKernelBase(self):
+  kernel = bytearray(0x200)
+  kernel[0:8] = struct.pack('<II', 0xeb00003e, 0xe1b0a005) # bl 0x100; movs r10, r5
+  kernel[0x100:0x104] = struct.pack('<I', 0xe28f3010) # add r3, pc, #0x10
+  kernel[0x118:0x11c] = struct.pack('<I', 0xc0008118)
+  with unittest.mock.patch.object(cache, 'defaultCache', cache.Cache(None, 0)):
+   self.assertEqual(kernel_patch.getKernelBase(bytes(kernel)), 0xc0008000)
+
+ def testSymbolIndex(self):
+  symbols = kernel_patch.SymbolIndex([0x1000, 0x1010, 0x1100], ['Tstart', 'tfoo', 'Tbar'])
+  parsed = kernel_patch.SymbolIndex.parse(symbols.dump())
+  self.assertEqual(list(parsed.addresses), [0x1000, 0x1010, 0x1100])
+  self.assertEqual(parsed.lookup('foo'), 0x1010)
+  self.assertEqual(parsed.symbolize(0x1014), ('foo', 4))
+  self.assertIsNone(parsed.symbolize(0xfff))
+
+ def testKallsyms(self):
+  names = ['Tstart', 'tfoo', 'Tbar']
+  addresses = [0xc0008000, 0xc0008010, 0xc0008100]
+  tokens = [b'x'] + [bytes([i]) for i in range(1, 256)]
+  namesData = b''.join(bytes([len(n)]) + n.encode() for n in names)
+  tokenTable = b''.join(t + b'\0' for t in tokens)
+  kernel = b'\x11' * 16
+  kernel += struct.pack('<%dI' % len(addresses), *addresses) + struct.pack('<I', len(names))
+  kernel += namesData.ljust((len(namesData) + 3) & ~3, b'\0')
+  kernel += struct.pack('<I', 0) # markers
+  kernel += tokenTable.ljust((len(tokenTable) + 3) & ~3, b'\0')
+  kernel += struct.pack('<256H', *(sum(len(t) + 1 for t in tokens[:i]) for i in range(256)))
+  with unittest.mock.patch.object(cache, 'defaultCache', cache.Cache(None, 0)):
+   symbols = kernel_patch.getSymbols(kernel)
+  self.assertEqual(symbols.names, names)
+  self.assertEqual(list(symbols.addresses), addresses)
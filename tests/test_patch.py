@@ -0,0 +1,23 @@
+from . import TestCase
+from runner import patch
+
+class TestPatch(TestCase):
+ def testWrite(self):
+  data = b'0123456789'
+  self.assertEqual(patch.apply(data, [patch.Write(2, b'ab', b'23'), patch.Write(8, b'cd')]), b'01ab4567cd')
+  self.assertEqual(data, b'0123456789')
+
+ def testWriteErrors(self):
+  with self.assertRaises(Exception):
+   patch.apply(b'0123', [patch.Write(3, b'ab')])
+  with self.assertRaises(Exception):
+   patch.apply(b'0123', [patch.Write(0, b'ab', b'xx')])
+
+ def testReplace(self):
+  self.assertEqual(patch.apply(b'aXbXc', [patch.Replace(b'X', b'YY')]), b'aYYbYYc')
+  self.assertEqual(patch.apply(b'aXb', [patch.Replace(b'X', b'XX', 1)]), b'aXXb')
+  self.assertEqual(patch.apply(b'aXb', [patch.Replace(b'Z', b'Y', 0)]), b'aXb')
+  with self.assertRaises(Exception):
+   patch.apply(b'aXbX', [patch.Replace(b'X', b'Y', 1)])
+  with self.assertRaises(ValueError):
+   patch.Replace(b'', b'')